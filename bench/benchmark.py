@@ -0,0 +1,166 @@
+"""Crawler throughput benchmark against the local fake LeetCode server.
+
+Each size runs LeetCodeCrawler.fetch_accepted_problems in a fresh process and a fresh
+database, so runs don't share state, and reports requests/s, p50/p99 request latency,
+wall time and DB write time.
+
+    python bench/benchmark.py --sizes 100 1000 5000 --workers 8 --engine async
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from configparser import RawConfigParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def write_config(directory, args):
+    """project.conf for one run: its own database, no response cache, the requested crawler settings"""
+    conf = RawConfigParser()
+    conf.read(os.path.join(ROOT, "project.conf"))
+    conf.set("DB", "path", os.path.join(directory, "data"))
+    conf.set("DB", "debug", "False")
+    if not conf.has_section("Cache"):
+        conf.add_section("Cache")
+    conf.set("Cache", "enabled", "False")
+    settings = {
+        "engine": args.engine, "max_workers": args.workers, "max_in_flight": args.in_flight or args.workers,
+        "batch_size": args.batch_size, "rate": args.rate, "max_rate": args.rate, "burst": args.workers,
+        "retry_base_delay": 0.1, "retry_max_delay": 2,
+    }
+    for key, value in settings.items():
+        conf.set("Crawler", key, str(value))
+    with open(os.path.join(directory, "project.conf"), "w") as f:
+        conf.write(f)
+
+
+def run_child(args):
+    """Crawl the fake server from inside the temporary directory and dump the client-side numbers"""
+    sys.path.insert(0, ROOT)
+    from crawler import LeetCodeCrawler
+    from database import create_tables
+    from utils import parser as conf
+
+    create_tables()
+    crawler = LeetCodeCrawler(
+        max_workers=conf.getint("Crawler", "max_workers"),
+        max_in_flight=conf.getint("Crawler", "max_in_flight"),
+        batch_size=conf.getint("Crawler", "batch_size"),
+        base_url=args.url
+    )
+
+    latencies, errors = [], [0]
+    request = crawler.session.request
+
+    def timed(method, url, *a, **kw):
+        try:
+            resp = request(method, url, *a, **kw)
+        except Exception:
+            errors[0] += 1
+            raise
+        latencies.append(resp.elapsed.total_seconds())
+        return resp
+
+    crawler.session.request = timed
+
+    started = time.perf_counter()
+    crawler.fetch_accepted_problems(engine=conf.get("Crawler", "engine"))
+    wall = time.perf_counter() - started
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "wall": wall,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "client_errors": errors[0],
+            "db_write_time": crawler.db_write_time,
+        }, f)
+
+
+def run_size(size, args):
+    sys.path.insert(0, BENCH_DIR)
+    from fake_leetcode import FakeLeetCode
+
+    server = FakeLeetCode(problems=size, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, rate_429=args.rate_429, retry_after=args.retry_after)
+    server.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            write_config(directory, args)
+            out = os.path.join(directory, "result.json")
+            env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", "--url", server.url, "--out", out],
+                cwd=directory, env=env, check=True,
+                stdout=None if args.verbose else subprocess.DEVNULL
+            )
+            with open(out) as f:
+                result = json.load(f)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    requests = sum(count for name, count in server.counts.items() if name not in ("429", "5xx"))
+    result.update(
+        problems=size,
+        requests=requests,
+        requests_per_second=requests / result["wall"] if result["wall"] else 0.0,
+        injected_429=server.counts.get("429", 0),
+        injected_5xx=server.counts.get("5xx", 0),
+        operations=server.counts,
+    )
+    return result
+
+
+def main():
+    args = argparse.ArgumentParser(description="Benchmark LeetCodeCrawler against a local fake LeetCode")
+    args.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    args.add_argument("--engine", choices=["threads", "async"], default="threads")
+    args.add_argument("--workers", type=int, default=8)
+    args.add_argument("--in-flight", type=int, default=None)
+    args.add_argument("--batch-size", type=int, default=1)
+    args.add_argument("--rate", type=float, default=1000, help="crawler requests-per-second budget")
+    args.add_argument("--latency", type=float, default=0.05, help="mean server latency in seconds")
+    args.add_argument("--jitter", type=float, default=0.01)
+    args.add_argument("--error-rate", type=float, default=0.0)
+    args.add_argument("--rate-429", type=float, default=0.0)
+    args.add_argument("--retry-after", type=int, default=1)
+    args.add_argument("--json", help="also write the results to this file")
+    args.add_argument("--verbose", action="store_true", help="show the crawler's output")
+    # internal: run one crawl in the current directory
+    args.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args.add_argument("--url", help=argparse.SUPPRESS)
+    args.add_argument("--out", help=argparse.SUPPRESS)
+    args = args.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    results = []
+    print(f"{'problems':>8} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'wall s':>8} {'db s':>8} {'429':>5} {'5xx':>5}")
+    for size in args.sizes:
+        result = run_size(size, args)
+        results.append(result)
+        print(f"{size:>8} {result['requests']:>8} {result['requests_per_second']:>8.1f} "
+              f"{result['p50'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f} {result['wall']:>8.2f} "
+              f"{result['db_write_time']:>8.3f} {result['injected_429']:>5} {result['injected_5xx']:>5}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
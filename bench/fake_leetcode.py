@@ -0,0 +1,178 @@
+"""Local stand-in for leetcode.com, for load-testing the crawler.
+
+Replays the recorded responses in fixtures.json for /api/problems/all/, the submission
+feed and the getQuestionDetail, QuestionNote, Submissions and submissionDetails GraphQL
+operations (plus the aliased getQuestionDetailBatch), renumbered for `problems` accepted
+problems. Latency, error rate and 429 injection are configurable.
+
+    python bench/fake_leetcode.py --problems 1000 --latency 0.05 --rate-429 0.01
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures.json")
+
+
+def slug_of(i):
+    return f"problem-{i}"
+
+
+def id_of(slug):
+    return int(slug.rsplit("-", 1)[1])
+
+
+class FakeLeetCode(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), problems=100, latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_429=0.0, retry_after=1, fixtures=FIXTURES):
+        super().__init__(address, FakeLeetCodeHandler)
+        with open(fixtures, "r", encoding="utf-8") as f:
+            self.fixtures = json.load(f)
+        self.problems = problems
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="fake-leetcode", daemon=True)
+        thread.start()
+        return thread
+
+    # responses, rebuilt from the fixtures for the requested problem
+
+    def problems_all(self):
+        body = copy.deepcopy(self.fixtures["problems_all"])
+        template = body["stat_status_pairs"][0]
+        pairs = []
+        for i in range(1, self.problems + 1):
+            pair = copy.deepcopy(template)
+            pair["stat"].update(question_id=i, frontend_question_id=i,
+                                question__title=f"Problem {i}", question__title_slug=slug_of(i))
+            pairs.append(pair)
+        body.update(stat_status_pairs=pairs, num_solved=self.problems, num_total=self.problems)
+        return body
+
+    def question(self, slug):
+        if not slug.startswith("problem-") or not 1 <= id_of(slug) <= self.problems:
+            return None
+        i = id_of(slug)
+        question = copy.deepcopy(self.fixtures["getQuestionDetail"])
+        question.update(questionId=str(i), questionFrontendId=str(i),
+                        questionTitle=f"Problem {i}", questionTitleSlug=slug)
+        note = copy.deepcopy(self.fixtures["QuestionNote"])
+        note["questionId"] = str(i)
+        question.update(article=note["article"], solution=note["solution"])
+        return question
+
+    def submissions(self, slug):
+        body = copy.deepcopy(self.fixtures["Submissions"])
+        for n, sub in enumerate(body["submissions"]):
+            sub["id"] = str(id_of(slug) * 10 + n)
+        return body
+
+    def graphql(self, payload):
+        operation = payload.get("operationName")
+        variables = payload.get("variables") or {}
+        if operation == "getQuestionDetailBatch":
+            return {"data": {f"q{name[4:]}": self.question(slug) for name, slug in variables.items()}}
+        if operation == "getQuestionDetail":
+            return {"data": {"question": self.question(variables["titleSlug"])}}
+        if operation == "QuestionNote":
+            question = self.question(variables["titleSlug"])
+            return {"data": {"question": question and {
+                "questionId": question["questionId"], "article": question["article"],
+                "solution": question["solution"], "__typename": "QuestionNode"}}}
+        if operation == "Submissions":
+            return {"data": {"submissionList": self.submissions(variables["questionSlug"])}}
+        if operation == "submissionDetails":
+            return {"data": {"submissionDetails": copy.deepcopy(self.fixtures["submissionDetails"])}}
+        return {"errors": [{"message": f"Unknown operation {operation}"}], "data": None}
+
+
+class FakeLeetCodeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay_or_fail(self, name):
+        """Sleep the configured latency, then maybe answer with an injected error; True if it did"""
+        server = self.server
+        server.count(name)
+        if server.latency or server.jitter:
+            time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        roll = random.random()
+        if roll < server.rate_429:
+            server.count("429")
+            self._send(429, {"error": "too many requests"}, {"Retry-After": str(server.retry_after)})
+            return True
+        if roll < server.rate_429 + server.error_rate:
+            server.count("5xx")
+            self._send(500, {"error": "internal error"})
+            return True
+        return False
+
+    def _send(self, status, body, headers=None):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/api/problems/all/":
+            if not self._delay_or_fail("problems_all"):
+                self._send(200, self.server.problems_all())
+        elif path == "/api/submissions/":
+            if not self._delay_or_fail("submissions_feed"):
+                self._send(200, self.server.fixtures["submissions_feed"])
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.split("?", 1)[0] != "/graphql":
+            self._send(404, {"error": "not found"})
+        elif not self._delay_or_fail(payload.get("operationName") or "graphql"):
+            self._send(200, self.server.graphql(payload))
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description="Serve a fake LeetCode account for crawler benchmarks")
+    args.add_argument("--port", type=int, default=8765)
+    args.add_argument("--problems", type=int, default=100)
+    args.add_argument("--latency", type=float, default=0.05, help="mean response latency in seconds")
+    args.add_argument("--jitter", type=float, default=0.01, help="standard deviation of the latency")
+    args.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    args.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with HTTP 429")
+    args = args.parse_args()
+
+    server = FakeLeetCode(("127.0.0.1", args.port), problems=args.problems, latency=args.latency,
+                          jitter=args.jitter, error_rate=args.error_rate, rate_429=args.rate_429)
+    print(f"[*] Serving {args.problems} problems on {server.url}")
+    server.serve_forever()
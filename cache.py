@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+from requests.models import Response
+
+from utils import FatalError, parser
+
+
+class OfflineCacheMiss(FatalError):
+    """Raised in offline mode when a request has no cached response; retrying cannot fill the cache"""
+
+
+class ResponseCache:
+    """Content-addressed cache of LeetCode responses on disk.
+
+    An entry is keyed on the endpoint plus the normalized GraphQL operation (name,
+    variables and whitespace-collapsed query), or the path for REST calls, and lives
+    in <directory>/<key[:2]>/<key>.json. How long an entry stays fresh is looked up
+    by operation name in `ttls`; operations without a TTL are not cached.
+    """
+
+    def __init__(self, directory, ttls, default_ttl=0):
+        self.directory = directory
+        self.ttls = {name.lower(): ttl for name, ttl in ttls.items()}
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def describe(method, url, data=None):
+        """Return (operation, normalized request) for a call"""
+        parts = urlsplit(url)
+        request = {"method": method.upper(), "endpoint": f"{parts.netloc}{parts.path}"}
+        operation = parts.path
+        if data:
+            try:
+                payload = json.loads(data)
+            except (TypeError, ValueError):
+                payload = None
+            if isinstance(payload, dict) and "query" in payload:
+                operation = payload.get("operationName") or operation
+                request.update(
+                    operation=operation,
+                    variables=payload.get("variables") or {},
+                    query=" ".join(payload["query"].split())
+                )
+            else:
+                request["data"] = data.decode("utf-8") if isinstance(data, bytes) else str(data)
+        return operation, request
+
+    def ttl(self, operation):
+        return self.ttls.get(operation.lower(), self.default_ttl)
+
+    def _path(self, request):
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def load(self, operation, request, stale=False):
+        """Return the cached body of a request, or None if it is missing or expired"""
+        path = self._path(request)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if not stale and time.time() - entry["stored"] > self.ttl(operation):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["body"]
+
+    def store(self, request, body):
+        path = self._path(request)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"stored": time.time(), "request": request, "body": body}, f)
+        os.replace(tmp, path)
+
+
+def make_response_cache(section="Cache", db_section="DB"):
+    """Build the response cache from project.conf; every key of `section` except
+    enabled/default_ttl is an operation name (or REST path) mapped to a TTL in seconds"""
+    reserved = {"enabled", "default_ttl"}
+    ttls = {
+        name: parser.getfloat(section, name)
+        for name in (parser.options(section) if parser.has_section(section) else [])
+        if name not in reserved
+    }
+    directory = os.path.join(parser.get(db_section, "path"), "cache")
+    return ResponseCache(directory, ttls, parser.getfloat(section, "default_ttl", fallback=0))
+
+
+def _is_cacheable(resp):
+    if resp.status_code != 200:
+        return False
+    try:
+        body = json.loads(resp.content)
+    except ValueError:
+        return False
+    return not (isinstance(body, dict) and body.get("errors"))
+
+
+def _cached_response(url, body):
+    resp = Response()
+    resp.status_code = 200
+    resp.url = url
+    resp.encoding = "utf-8"
+    resp._content = body.encode("utf-8")
+    return resp
+
+
+def cache_session(session, cache, offline=False):
+    """Serve requests made through a requests.Session from the cache when possible.
+    In offline mode any cached entry is used regardless of age and a miss raises OfflineCacheMiss."""
+    request = session.request
+
+    def cached(method, url, *args, **kwargs):
+        operation, normalized = cache.describe(method, url, kwargs.get("data"))
+        if offline or cache.ttl(operation) > 0:
+            body = cache.load(operation, normalized, stale=offline)
+            if body is not None:
+                return _cached_response(url, body)
+        if offline:
+            raise OfflineCacheMiss(f"{operation} is not cached")
+
+        resp = request(method, url, *args, **kwargs)
+        if cache.ttl(operation) > 0 and _is_cacheable(resp):
+            cache.store(normalized, resp.content.decode("utf-8"))
+        return resp
+
+    session.request = cached
+    return session
@@ -0,0 +1,95 @@
+import zlib
+
+from peewee import TextField
+
+# Text shorter than this (in UTF-8 bytes) is stored as is, zlib would barely shrink it
+MIN_SIZE = 256
+LEVEL = 6
+
+# Preset dictionary: fragments that recur in problem descriptions, solution articles and
+# submissions. zlib can reference it from the first byte of every value, which is where
+# most of the gain on these short, separately compressed texts comes from. zlib keeps the
+# last 32 KB and codes nearby bytes more cheaply, so the most common fragments come last.
+# Never edit a dictionary that has been written with; add a new one under a new header.
+DICTIONARY_V1 = "".join([
+    # submissions (crawler.py stores them with \\uXXXX escapes)
+    "\\u000A    \\u000A        \\u000A            \\u003D \\u0026\\u0026 \\u007C\\u007C \\u003C \\u003E "
+    "\\u0021\\u003D \\u002D1 \\u002B\\u002B \\u003B \\u0027 \\u0022 ",
+    "class Solution:\n    def __init__(self):\n        self.\n        return \n        for i in range(len(",
+    "class Solution {\npublic:\n    vector<int> int n = nums.size();\n        for (int i = 0; i < n; i++) {\n"
+    "        return ;\n    }\n};\n",
+    "func (nums []int) int {\n\tfor i := 0; i < len(nums); i++ {\n\t}\n\treturn \n}\n",
+    "public class Solution {\n    public int  for (int i = 0; i < n; i++) {\n    }\n}\n",
+    # solution articles
+    "[TOC]\n\n## Solution\n\n---\n\n### Approach 1: \n\n#### Intuition\n\n#### Algorithm\n\n"
+    "#### Implementation\n\n#### Complexity Analysis\n\nLet $n$ be the length of `nums`.\n\n"
+    "* Time complexity : $$O(n)$$. * Space complexity : $$O(1)$$. <iframe src=\"https://leetcode.com/playground/",
+    "/shared\" frameBorder=\"0\" width=\"100%\" height=\"500\" name=\"\"></iframe>\n\n",
+    "![image](https://leetcode.com/problems/Figures/ Let's where we the of the and to is in a ",
+    # problem descriptions
+    "<p>Given an integer array <code>nums</code>, return <em>the number of </em> "
+    "Given the <code>root</code> of a binary tree, return You are given a string <code>s</code> "
+    "You may assume that each input would have exactly one solution.</p>\n\n",
+    "<p><strong>Follow up:</strong> Could you do it in <code>O(n)</code> time?</p>\n",
+    "<img alt=\"\" src=\"https://assets.leetcode.com/uploads/ style=\"width: px; height: px;\" />",
+    "<strong>Explanation:</strong> <strong>Input:</strong> nums = [1,2,3], target = ",
+    "<p><strong>Constraints:</strong></p>\n\n<ul>\n\t<li><code>1 &lt;= nums.length &lt;= 10<sup>5</sup></code></li>\n"
+    "\t<li><code>-10<sup>4</sup> &lt;= nums[i] &lt;= 10<sup>4</sup></code></li>\n</ul>\n",
+    "<p>&nbsp;</p>\n<p><strong class=\"example\">Example 1:</strong></p>\n\n<pre>\n<strong>Input:</strong> ",
+    "\n<strong>Output:</strong> \n<strong>Explanation:</strong> \n</pre>\n\n"
+    "<p><strong class=\"example\">Example 2:</strong></p>\n\n<pre>\n<strong>Input:</strong> ",
+    "</code> and <code></code>, return </code> is </code></li>\n\t<li><code>&quot;</p>\n\n<p>",
+]).encode("utf-8")
+
+# first byte of a compressed value -> preset dictionary it was compressed with
+DICTIONARIES = {b"\x01": DICTIONARY_V1}
+CURRENT = b"\x01"
+
+
+def compress(text):
+    """`text` as a compressed BLOB (a header byte naming the dictionary, then the zlib stream),
+    or unchanged when it is too short to be worth it"""
+    data = text.encode("utf-8")
+    if len(data) < MIN_SIZE:
+        return text
+    compressor = zlib.compressobj(LEVEL, zdict=DICTIONARIES[CURRENT])
+    packed = compressor.compress(data) + compressor.flush()
+    if len(packed) + 1 >= len(data):
+        return text
+    return CURRENT + packed
+
+
+def decompress(value):
+    """Inverse of compress(); text values (short ones, or rows written before compression) pass through"""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    decompressor = zlib.decompressobj(zdict=DICTIONARIES[value[:1]])
+    return (decompressor.decompress(value[1:]) + decompressor.flush()).decode("utf-8")
+
+
+class CompressedTextField(TextField):
+    """A TextField stored zlib-compressed; reads and writes still see str. The column keeps
+    its TEXT type and SQLite stores compressed values as BLOBs in it, so old rows (plain
+    text) stay readable and compress_columns() can convert a table in place."""
+
+    def db_value(self, value):
+        return None if value is None else compress(self.adapt(value))
+
+    def python_value(self, value):
+        return decompress(value)
+
+
+def compress_columns(database, fields):
+    """Rewrite the plain-text values of CompressedTextFields in place, for migrating a
+    database written before the columns were compressed"""
+    for field in fields:
+        model = field.model
+        table, column, key = model._meta.table_name, field.column_name, model._meta.primary_key.column_name
+        rows = database.execute_sql(
+            f'SELECT "{key}", "{column}" FROM "{table}" WHERE typeof("{column}") = \'text\''
+        ).fetchall()
+        for row_key, text in rows:
+            packed = compress(text)
+            if packed is not text:
+                database.execute_sql(f'UPDATE "{table}" SET "{column}" = ? WHERE "{key}" = ?', (packed, row_key))
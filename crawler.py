@@ -1,164 +1,132 @@
 import json
-import os.path
-import pickle
-import re
-from sys import exit
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+import time
 
-import requests
-from requests.cookies import RequestsCookieJar
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-
-from database import Problem, ProblemTag, Tag, Submission, create_tables, Solution
-from utils import destructure, random_wait, do, get
+import database
+from database import Submission, create_tables, Solution, SyncState
+from engine import CrawlEngine, SiteProfile
+from utils import get, FatalError, RetryableError
+from metrics import metrics
 
+BASE_URL = "https://leetcode.com"
 COOKIE_PATH = "./cookies.dat"
 
+SITE = SiteProfile(
+    url=BASE_URL,
+    database=database,
+    section="Crawler",
+    db_section="DB",
+    cookie_path=COOKIE_PATH,
+    fields={"title": "questionTitle", "description": "content", "tag_name": "name"},
+    incremental=True
+)
 
-class LeetCodeCrawler:
-    def __init__(self, max_workers=5):
-        # create an http session
-        self.session = requests.Session()
-        self.browser = webdriver.Edge()
-        self.max_workers = max_workers
-        self.lock = threading.Lock()  # for thread-safe database operations
-        self.session.headers.update(
-            {
-                'Host': 'leetcode.com',
-                'Cache-Control': 'max-age=0',
-                'Upgrade-Insecure-Requests': '1',
-                'Referer': 'https://leetcode.com/accounts/login/',
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.98 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6',
-                'Connection': 'keep-alive'
-            }
-        )
+# union of the getQuestionDetail and QuestionNote selections, used by the aliased batch query
+BATCH_QUESTION_FIELDS = """
+    questionId
+    questionFrontendId
+    questionTitle
+    questionTitleSlug
+    content
+    difficulty
+    stats
+    similarQuestions
+    categoryTitle
+    topicTags {
+        name
+        slug
+    }
+    article
+    solution {
+        id
+        content
+        contentTypeId
+        canSeeDetail
+        paidOnly
+    }
+"""
 
-    def login(self):
-        print("[*] Starting browser login..., please fill the login form")
-        print("[*] You have 1 minute to log in to your LeetCode account")
-        try:
-            # browser login
-            login_url = "https://leetcode.com/accounts/login"
-            self.browser.get(login_url)
 
-            # Wait up to 1 minute (60 seconds) for login to complete
-            # Check if the URL changes (no longer contains "login")
-            WebDriverWait(self.browser, 60).until(
-                lambda driver: "login" not in driver.current_url.lower()
-            )
-            print("[+] Login detected! Waiting 30 seconds for session to stabilize...")
-            import time
-            time.sleep(30)  # Wait 30 seconds for cookies and session to be fully established
-            
-            browser_cookies = self.browser.get_cookies()
-            print(f"[+] Login successfully, obtained {len(browser_cookies)} cookies")
+class LeetCodeCrawler(CrawlEngine):
+    """leetcode.com: problems, official solutions and the latest accepted submission, with
+    batched problem queries and incremental sync (see engine.CrawlEngine)"""
 
-        except Exception as e:
-            print(f"[-] Login Failed: {e}, please try again")
-            exit()
+    def __init__(self, max_workers=5, max_in_flight=None, batch_size=1, offline=False,
+                 full_sync_days=30, activity_max_pages=50, submission_page_size=20, submission_max_pages=10,
+                 base_url=BASE_URL):
+        super().__init__(
+            SITE, max_workers=max_workers, max_in_flight=max_in_flight, batch_size=batch_size, offline=offline,
+            full_sync_days=full_sync_days, activity_max_pages=activity_max_pages,
+            submission_page_size=submission_page_size, submission_max_pages=submission_max_pages,
+            base_url=base_url
+        )
 
-        cookies = RequestsCookieJar()
-        csrf_token = None
-        for item in browser_cookies:
-            cookies.set(item['name'], item['value'])
+    @staticmethod
+    def _batch_query(slugs):
+        variables = {f"slug{i}": slug for i, slug in enumerate(slugs)}
+        definitions = ", ".join(f"${name}: String!" for name in variables)
+        selections = "\n".join(
+            f"q{i}: question(titleSlug: $slug{i}) {{ {BATCH_QUESTION_FIELDS} }}" for i in range(len(slugs))
+        )
+        return {
+            'operationName': "getQuestionDetailBatch",
+            'variables': variables,
+            'query': f"query getQuestionDetailBatch({definitions}) {{\n{selections}\n}}"
+        }
 
-            if item['name'] == 'csrftoken':
-                csrf_token = item['value']
-                self.session.headers.update({
-                    "x-csrftoken": item['value']
-                })
+    def _batch_item_request(self, slug):
+        # each slug of a batch is cached as a batch of one, so hits don't depend on how slugs were grouped
+        return self.cache.describe("POST", self.graphql_url, json.dumps(self._batch_query([slug])))
 
-        self.session.cookies.update(cookies)
-        
-        # Verify authentication by checking if we can access /api/problems/all/
-        print("[*] Verifying authentication...")
-        try:
-            response = self.session.get("https://leetcode.com/api/problems/all/")
-            if response.status_code == 200:
-                data = json.loads(response.content.decode('utf-8'))
-                if 'stat_status_pairs' in data:
-                    print(f"[+] Authentication verified! Found {len(data['stat_status_pairs'])} problems")
-                else:
-                    print("[-] Authentication failed: Invalid response format")
-                    print(f"[-] Response keys: {list(data.keys())}")
-            else:
-                print(f"[-] Authentication failed: Status code {response.status_code}")
-                print(f"[-] Response: {response.text[:200]}")
-        except Exception as e:
-            print(f"[-] Error verifying authentication: {e}")
+    @metrics.timed("problem_batch")
+    def fetch_problems_batch(self, slugs, accepted=False):
+        """Fetch problem details and solutions for several slugs in one aliased GraphQL query.
+        Returns the slugs that were stored; the others are left for the single-slug queries."""
+        questions = {}
+        if self.cache is not None:
+            for slug in slugs:
+                operation, request = self._batch_item_request(slug)
+                body = self.cache.load(operation, request, stale=self.offline)
+                if body is not None:
+                    questions[slug] = get(json.loads(body), "data.q0")
 
+        missing = [slug for slug in slugs if questions.get(slug) is None]
+        if missing:
+            print(f"[*] Fetching {len(missing)} problems in one batch: {', '.join(missing)}")
+            try:
+                resp = self.session.post(
+                    self.graphql_url,
+                    data=json.dumps(self._batch_query(missing)).encode('utf8'),
+                    headers={
+                        "content-type": "application/json",
+                    })
+                body = json.loads(resp.content)
+            except Exception as e:
+                print(f"[!] Batch failed, falling back to single queries: {e}")
+                body = {}
 
-    def _process_problem(self, slug, is_new):
-        """Process a single problem: fetch problem, solution, and submission"""
-        try:
-            if is_new:
-                # fetch problem and solution for new problems
-                do(self.fetch_problem, args=[slug, True])
-                do(self.fetch_solution, args=[slug])
-            
-            # always try to update submission
-            do(self.fetch_submission, args=[slug])
-            return True, slug, is_new
-        except Exception as e:
-            print(f"[!] Error processing {slug}: {e}")
-            return False, slug, is_new
+            # split the aliased response back out per slug
+            for i, slug in enumerate(missing):
+                question = get(body, f"data.q{i}")
+                if question is None:
+                    continue
+                questions[slug] = question
+                if self.cache is not None:
+                    self.cache.store(self._batch_item_request(slug)[1], json.dumps({"data": {"q0": question}}))
 
-    def fetch_accepted_problems(self):
-        response = self.session.get("https://leetcode.com/api/problems/all/")
-        all_problems = json.loads(response.content.decode('utf-8'))
-        
-        # Prepare list of problems to process
-        problems_to_process = []
-        total_ac = 0
-        
-        for item in all_problems['stat_status_pairs']:
-            if item['status'] == 'ac':
-                total_ac += 1
-                id, slug = destructure(item['stat'], "question_id", "question__title_slug")
-                is_new = Problem.get_or_none(Problem.id == id) is None
-                problems_to_process.append((slug, is_new))
-        
-        print(f"[*] Total AC problems: {total_ac}")
-        print(f"[*] Processing {len(problems_to_process)} problems with {self.max_workers} workers...")
-        
-        # Process problems in parallel
-        new_problems = 0
-        existing_problems = 0
-        successful = 0
-        failed = 0
-        
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # Submit all tasks
-            future_to_problem = {executor.submit(self._process_problem, slug, is_new): (slug, is_new) 
-                                for slug, is_new in problems_to_process}
-            
-            # Process completed tasks
-            for future in as_completed(future_to_problem):
-                slug, is_new = future_to_problem[future]
-                try:
-                    success, _, was_new = future.result()
-                    if success:
-                        successful += 1
-                        if was_new:
-                            new_problems += 1
-                        else:
-                            existing_problems += 1
-                    else:
-                        failed += 1
-                except Exception as e:
-                    print(f"[!] Exception for {slug}: {e}")
-                    failed += 1
-        
-        print(f"[*] New problems added: {new_problems}")
-        print(f"[*] Existing problems (submissions updated): {existing_problems}")
-        print(f"[*] Successful: {successful}, Failed: {failed}")
+        fetched = []
+        for slug in slugs:
+            question = questions.get(slug)
+            if question is None:
+                continue
+            try:
+                self._save_problem(slug, question, accepted)
+                self._save_solution(slug, question)
+                fetched.append(slug)
+            except Exception as e:
+                print(f"[!] Cannot store batched result for {slug}: {e}")
+        return fetched
 
+    @metrics.timed("problem")
     def fetch_problem(self, slug, accepted=False):
         print(f"[*] Fetching problem: https://leetcode.com/problem/{slug}/...")
         query_params = {
@@ -184,7 +152,7 @@ class LeetCodeCrawler:
         }
 
         resp = self.session.post(
-            "https://leetcode.com/graphql",
+            self.graphql_url,
             data=json.dumps(query_params).encode('utf8'),
             headers={
                 "content-type": "application/json",
@@ -193,26 +161,11 @@ class LeetCodeCrawler:
 
         # parse data
         question = get(body, 'data.question')
+        if question is None:
+            raise FatalError(f"No question found for slug: {slug}")
+        self._save_problem(slug, question, accepted)
 
-        Problem.replace(
-            id=question['questionId'], display_id=question['questionFrontendId'], title=question["questionTitle"],
-            level=question["difficulty"], slug=slug, description=question['content'],
-            accepted=accepted
-        ).execute()
-
-        for item in question['topicTags']:
-            if Tag.get_or_none(Tag.slug == item['slug']) is None:
-                Tag.replace(
-                    name=item['name'],
-                    slug=item['slug']
-                ).execute()
-
-            ProblemTag.replace(
-                problem=question['questionId'],
-                tag=item['slug']
-            ).execute()
-        random_wait(1, 3)  # Small delay to avoid rate limiting
-
+    @metrics.timed("solution")
     def fetch_solution(self, slug):
         print(f"[*] Fetching solution for problem: {slug}")
         query_params = {
@@ -246,7 +199,7 @@ class LeetCodeCrawler:
             }
             '''
         }
-        resp = self.session.post("https://leetcode.com/graphql",
+        resp = self.session.post(self.graphql_url,
                                  data=json.dumps(query_params).encode('utf8'),
                                  headers={
                                      "content-type": "application/json",
@@ -255,20 +208,29 @@ class LeetCodeCrawler:
 
         # parse data
         solution = get(body, "data.question")
+        if solution is None:
+            raise FatalError(f"No question found for slug: {slug}")
+        self._save_solution(slug, solution)
+
+    def _save_solution(self, slug, solution):
         solutionExist = solution['solution'] is not None and solution['solution']['paidOnly'] is False
         if solutionExist:
-            Solution.replace(
+            self._write(
+                Solution,
                 problem=solution['questionId'],
                 url=f"https://leetcode.com/articles/{slug}/",
                 content=solution['solution']['content']
-            ).execute()
-        random_wait(1, 3)  # Small delay to avoid rate limiting
+            )
 
-    def fetch_submission(self, slug):
-        print(f"[*] Fetching submission for problem: {slug}")
+    def _fetch_submission_list(self, slug):
+        """Page through a problem's submissions, newest first, until the first accepted
+        one or one already stored (both mean nothing older matters), the last page, or
+        submission_max_pages pages. A normal run therefore costs a single request.
+        Returns the submissions and whether the history was read to one of those ends,
+        False when it was cut off at submission_max_pages."""
         query_params = {
             'operationName': "Submissions",
-            'variables': {"offset": 0, "limit": 20, "lastKey": '', "questionSlug": slug},
+            'variables': {"offset": 0, "limit": self.submission_page_size, "lastKey": '', "questionSlug": slug},
             'query': '''query Submissions($offset: Int!, $limit: Int!, $lastKey: String, $questionSlug: String!) {
                                         submissionList(offset: $offset, limit: $limit, lastKey: $lastKey, questionSlug: $questionSlug) {
                                         lastKey
@@ -287,8 +249,9 @@ class LeetCodeCrawler:
                                     }
                                 }'''
         }
-        try:
-            resp = self.session.post("https://leetcode.com/graphql",
+        submissions = []
+        for page in range(self.submission_max_pages):
+            resp = self.session.post(self.graphql_url,
                                      data=json.dumps(query_params).encode('utf8'),
                                      headers={
                                          "content-type": "application/json",
@@ -296,10 +259,32 @@ class LeetCodeCrawler:
             body = json.loads(resp.content)
 
             # parse data
-            submissions = get(body, "data.submissionList.submissions")
+            submission_list = get(body, "data.submissionList")
+            for sub in submission_list['submissions']:
+                submissions.append(sub)
+                if sub['statusDisplay'] == 'Accepted' or self._exists(Submission, sub['id']):
+                    return submissions, True
+
+            if not submission_list['hasNext']:
+                return submissions, True
+            query_params['variables']['offset'] += len(submission_list['submissions'])
+            query_params['variables']['lastKey'] = submission_list['lastKey']
+
+        print(f"    - Stopped after {self.submission_max_pages} pages of submissions")
+        return submissions, False
+
+    @metrics.timed("submission")
+    def fetch_submission(self, slug):
+        print(f"[*] Fetching submission for problem: {slug}")
+        synced = False
+        try:
+            submissions, complete = self._fetch_submission_list(slug)
             
             # filter for accepted submissions and find the latest one
-            accepted_submissions = [sub for sub in submissions if sub['statusDisplay'] == 'Accepted']
+            latest_submission = None
+            # a stored submission is always an accepted one
+            accepted_submissions = [sub for sub in submissions
+                                    if sub['statusDisplay'] == 'Accepted' or self._exists(Submission, sub['id'])]
             
             print(f"    - Total submissions returned: {len(submissions)}, Accepted: {len(accepted_submissions)}")
             
@@ -310,8 +295,7 @@ class LeetCodeCrawler:
                 print(f"    - Latest submission ID: {latest_submission['id']}, Timestamp: {latest_submission['timestamp']}")
                 
                 # check if this submission is already in the database
-                existing = Submission.get_or_none(Submission.id == latest_submission['id'])
-                if existing is None:
+                if not self._exists(Submission, latest_submission['id']):
                     print(f"    - Submission not in DB, fetching code...")
                     try:
                         submission_id = latest_submission['id']
@@ -343,7 +327,7 @@ class LeetCodeCrawler:
                         }
                         
                         submission_resp = self.session.post(
-                            "https://leetcode.com/graphql",
+                            self.graphql_url,
                             data=json.dumps(query_params).encode('utf8'),
                             headers={"content-type": "application/json"}
                         )
@@ -353,14 +337,16 @@ class LeetCodeCrawler:
                             code = get(submission_data, "data.submissionDetails.code")
                             
                             if code:
-                                Submission.insert(
+                                self._write(
+                                    Submission,
                                     id=latest_submission['id'],
                                     slug=slug,
                                     language=latest_submission['lang'],
                                     created=latest_submission['timestamp'],
                                     source=code.encode('utf-8')
-                                ).execute()
-                                print(f"    - Submission saved successfully")
+                                )
+                                print(f"    - Submission queued for saving")
+                                synced = True
                             else:
                                 print(f"    - WARNING: Cannot extract submission code for problem: {slug}")
                                 print(f"    - Response data: {submission_data}")
@@ -369,20 +355,35 @@ class LeetCodeCrawler:
                             print(f"    - ERROR: Failed to fetch submission details, status: {submission_resp.status_code}")
                             print(f"    - Response: {submission_resp.text[:200]}")
                     
+                    except RetryableError:
+                        raise  # let the retry policy back off and try again
                     except Exception as e:
                         print(f"    - ERROR fetching submission code: {type(e).__name__}: {str(e)}")
                         print(f"    - Skipping this submission due to error")
                         # Don't crash, just skip and continue
                 else:
                     print(f"    - Submission already in DB, skipping")
-            else:
+                    synced = True
+            elif complete:
                 print(f"    - No accepted submissions found")
+                synced = True
+            else:
+                # an accepted one may be older than the pages read, so check again next run
+                print(f"    - No accepted submissions in the pages read, history truncated")
         
+        except RetryableError:
+            raise
         except Exception as e:
             print(f"    - ERROR in fetch_submission: {type(e).__name__}: {str(e)}")
             print(f"    - Continuing with next problem...")
-        
-        random_wait(1, 2)  # Small delay to avoid rate limiting
+
+        # only a complete check lets later runs skip this problem
+        if synced:
+            self._write(
+                SyncState,
+                slug=slug,
+                checked_at=int(time.time())
+            )
 
 
 if __name__ == '__main__':
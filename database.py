@@ -1,9 +1,12 @@
+import json
 import logging
 import pathlib
 
 from peewee import *
 
-from utils import parser
+import search
+from compression import CompressedTextField, compress_columns, decompress
+from utils import migrate, parser, schema_version, sqlite_options
 
 if parser.get("DB", "debug") == "True":
     # logger
@@ -15,7 +18,10 @@ if parser.get("DB", "debug") == "True":
 directory = parser.get("DB", "path")
 p = pathlib.Path(directory)
 p.mkdir(parents=True, exist_ok=True)
-database = SqliteDatabase(directory + "/LeetCode.sqlite")
+# WAL, pragmas and per-thread connections, see [DB] in project.conf
+database = SqliteDatabase(directory + "/LeetCode.sqlite", **sqlite_options("DB"))
+# the search index triggers call search_text(), see search.py
+search.register(database)
 
 
 # data models
@@ -29,7 +35,7 @@ class Problem(BaseModel):
     level = CharField()
     title = CharField()
     slug = CharField(unique=True)
-    description = TextField()
+    description = CompressedTextField()
     accepted = BooleanField()
 
     # find the tags related to this question
@@ -55,7 +61,7 @@ class Problem(BaseModel):
 class Submission(BaseModel):
     slug = ForeignKeyField(Problem, 'slug', backref='submissions')
     language = CharField()
-    source = TextField()
+    source = CompressedTextField()
     created = DateField()
 
 
@@ -71,7 +77,8 @@ class Tag(BaseModel):
             ).where(
                 ProblemTag.tag == self.slug
             ).order_by(
-                Problem.id
+                # the same ids as Problem.id, but in the order of the (tag, problem) index
+                ProblemTag.problem
             )
         )
 
@@ -89,13 +96,199 @@ class ProblemTag(BaseModel):
 
 class Solution(BaseModel):
     problem = ForeignKeyField(Problem, primary_key=True)
-    content = TextField()
+    content = CompressedTextField()
     url = CharField()
 
 
+class HighlightedCode(BaseModel):
+    # code_to_html output, see renderer.HighlightCache for how the key is built
+    key = CharField(primary_key=True)
+    html = CompressedTextField()
+
+
+class RenderedNote(BaseModel):
+    # last rendered field list of each problem's note and the hash of what it was rendered from
+    problem = IntegerField(primary_key=True)
+    input_hash = CharField()
+    fields = CompressedTextField()
+
+
+class SyncState(BaseModel):
+    # per-problem submission sync bookkeeping, lets a run skip problems without new activity
+    slug = CharField(primary_key=True)
+    checked_at = IntegerField()
+
+
+def load_sync_state():
+    return {state.slug: state for state in SyncState.select()}
+
+
+def load_problem_tags():
+    """Tags of every problem keyed by problem id, in one query"""
+    tags = {}
+    query = (
+        ProblemTag.select(ProblemTag.problem, Tag)
+        .join(Tag, on=Tag.slug == ProblemTag.tag)
+        .order_by(ProblemTag.problem, ProblemTag.tag)
+    )
+    for row in query.objects(Tag):
+        tags.setdefault(row.problem, []).append(row)
+    return tags
+
+
+def render_rows_query():
+    """Every problem, ordered by display id, with its latest submission
+    (submission_source / submission_language, None if there is none) and its last
+    rendered note (input_hash / fields, None if never rendered)"""
+    # rank each problem's submissions newest first and keep the top one
+    latest = Submission.select(
+        Submission.slug,
+        Submission.source,
+        Submission.language,
+        fn.ROW_NUMBER().over(
+            partition_by=[Submission.slug],
+            order_by=[Submission.created.desc(), Submission.id]
+        ).alias('rank')
+    ).alias('latest')
+    return (
+        Problem.select(
+            Problem,
+            latest.c.source.alias('submission_source'),
+            latest.c.language.alias('submission_language'),
+            RenderedNote.input_hash,
+            RenderedNote.fields
+        )
+        .join(latest, JOIN.LEFT_OUTER, on=(latest.c.slug_id == Problem.slug) & (latest.c.rank == 1))
+        .switch(Problem)
+        .join(RenderedNote, JOIN.LEFT_OUTER, on=RenderedNote.problem == Problem.id)
+        .order_by(Problem.display_id)
+    )
+
+
+def iter_render_rows():
+    """Stream the rows of render_rows_query as dicts, with the note fields decoded. One query,
+    read lazily, so memory does not grow with the number of problems."""
+    for row in render_rows_query().dicts().iterator():
+        # a subquery column has no field to convert it, so the source comes back compressed
+        row['submission_source'] = decompress(row['submission_source'])
+        if row['fields'] is not None:
+            row['fields'] = json.loads(row['fields'])
+        yield row
+
+
+def stage_rendered_notes(notes):
+    """Set (problem id, input hash, field list) triples aside in a temporary table of this
+    connection; commit_rendered_notes() stores them in RenderedNote once the render's packages
+    are written. Unlike one long transaction, this holds no write lock on the database meanwhile."""
+    database.execute_sql('CREATE TEMP TABLE IF NOT EXISTS "renderednote_staged" '
+                         '("problem" INTEGER PRIMARY KEY, "input_hash" TEXT, "fields" TEXT)')
+    rows = [(problem, digest, RenderedNote.fields.db_value(json.dumps(fields))) for problem, digest, fields in notes]
+    with database.atomic():
+        for batch in chunked(rows, 100):
+            database.execute_sql(
+                'INSERT OR REPLACE INTO "renderednote_staged" VALUES ' + ", ".join(["(?, ?, ?)"] * len(batch)),
+                [value for row in batch for value in row]
+            )
+
+
+def commit_rendered_notes():
+    """Move the staged notes into RenderedNote in one transaction"""
+    if not database.table_exists("renderednote_staged", schema="temp"):
+        return
+    with database.atomic():
+        database.execute_sql('INSERT OR REPLACE INTO "renderednote" ("problem", "input_hash", "fields") '
+                             'SELECT "problem", "input_hash", "fields" FROM "renderednote_staged"')
+        database.execute_sql('DELETE FROM "renderednote_staged"')
+
+
+def discard_rendered_notes():
+    # not DROP TABLE, which fails while a render's read cursor is still open
+    if database.table_exists("renderednote_staged", schema="temp"):
+        database.execute_sql('DELETE FROM "renderednote_staged"')
+
+
+def search_problems(text, column=None, language=None, limit=20, raw=False):
+    """Full-text search of the stored problems, see search.search"""
+    return search.search(database, text, column, language, limit, raw)
+
+
+def load_known_keys():
+    """Primary keys already stored, one query per table, for crawl-time existence checks"""
+    return {
+        model: {key for key, in model.select(model._meta.primary_key).tuples()}
+        for model in (Problem, Submission, Tag)
+    }
+
+
+def _add_hot_query_indexes(db):
+    """indexes for the latest submission of a problem and for the problems of a tag"""
+    # render_rows_query: a problem's submissions newest first
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "submission_slug_id_created" '
+                   'ON "submission" ("slug_id", "created" DESC, "id")')
+    # Tag.problems: problem ids of a tag without touching the table
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "problemtag_tag_id_problem_id" ON "problemtag" ("tag_id", "problem_id")')
+
+
+def _compress_text_columns(db):
+    """compress the stored problem descriptions, solutions and submission sources"""
+    compress_columns(db, [Problem.description, Solution.content, Submission.source])
+
+
+def _add_search_index(db):
+    """full-text search index over problems, solutions and submissions"""
+    search.create_index(db)
+
+
+# (schema version, migration) in order; append new ones, never edit or reorder applied ones
+MIGRATIONS = [
+    (1, _add_hot_query_indexes),
+    (2, _compress_text_columns),
+    (3, _add_search_index),
+]
+
+
+def query_plans():
+    """EXPLAIN QUERY PLAN of the hot queries, as (name, plan lines, index-backed) triples;
+    a plan is index-backed when it never scans a table without an index or sorts in a temp b-tree"""
+    hot = {
+        "latest submission of a problem": (
+            Submission.select().where(Submission.slug == "two-sum")
+            .order_by(Submission.created.desc(), Submission.id).limit(1)
+        ),
+        "problems of a tag": Tag(slug="array").problems,
+        "tags of a problem": Problem(id=1).tags,
+        "problems by display id": Problem.select().order_by(Problem.display_id),
+        "render rows": render_rows_query(),
+    }
+    plans = []
+    for name, query in hot.items():
+        sql, params = query.sql()
+        lines = [row[-1] for row in database.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        # scanning a materialized subquery is fine, scanning a table without an index is not
+        backed = not any(
+            line.startswith("USE TEMP B-TREE")
+            or (line.startswith("SCAN ") and not line.startswith("SCAN (") and " USING " not in line)
+            for line in lines
+        )
+        plans.append((name, lines, backed))
+    return plans
+
+
+TABLES = [Problem, Solution, Submission, Tag, ProblemTag, SyncState, HighlightedCode, RenderedNote]
+
+
+def schema_is_current():
+    """True when create_tables() has nothing to create or migrate"""
+    with database.connection_context():
+        return all(model.table_exists() for model in TABLES) and schema_version(database) >= MIGRATIONS[-1][0]
+
+
 def create_tables():
-    with database:
-        database.create_tables([Problem, Solution, Submission, Tag, ProblemTag])
+    # no surrounding transaction: every migration commits on its own and VACUUM cannot run in one
+    with database.connection_context():
+        database.create_tables(TABLES)
+        # existing databases upgrade in place, see MIGRATIONS
+        migrate(database, MIGRATIONS)
 
 
 if __name__ == '__main__':
@@ -3,7 +3,9 @@ import pathlib
 
 from peewee import *
 
-from utils import parser
+import search
+from compression import CompressedTextField, compress_columns
+from utils import migrate, parser, schema_version, sqlite_options
 
 if parser.get("DB_CN", "debug") == "True":
     # logger
@@ -15,7 +17,10 @@ if parser.get("DB_CN", "debug") == "True":
 directory = parser.get("DB_CN", "path")
 p = pathlib.Path(directory)
 p.mkdir(parents=True, exist_ok=True)
-database = SqliteDatabase(directory + "/LeetCode_cn.sqlite")
+# WAL, pragmas and per-thread connections, see [DB_CN] in project.conf
+database = SqliteDatabase(directory + "/LeetCode_cn.sqlite", **sqlite_options("DB_CN"))
+# the search index triggers call search_text(), see search.py
+search.register(database)
 
 
 # data models
@@ -29,7 +34,7 @@ class Problem(BaseModel):
     level = CharField()
     title = CharField()
     slug = CharField(unique=True)
-    description = TextField()
+    description = CompressedTextField()
     accepted = BooleanField()
 
     # find the tags related to this question
@@ -55,7 +60,7 @@ class Problem(BaseModel):
 class Submission(BaseModel):
     slug = ForeignKeyField(Problem, 'slug', backref='submissions')
     language = CharField()
-    source = TextField()
+    source = CompressedTextField()
     created = DateField()
 
 
@@ -71,7 +76,8 @@ class Tag(BaseModel):
             ).where(
                 ProblemTag.tag == self.slug
             ).order_by(
-                Problem.id
+                # the same ids as Problem.id, but in the order of the (tag, problem) index
+                ProblemTag.problem
             )
         )
 
@@ -89,13 +95,63 @@ class ProblemTag(BaseModel):
 
 class Solution(BaseModel):
     problem = ForeignKeyField(Problem, primary_key=True)
-    content = TextField()
+    content = CompressedTextField()
     url = CharField()
 
 
+def search_problems(text, column=None, language=None, limit=20, raw=False):
+    """Full-text search of the stored problems, see search.search"""
+    return search.search(database, text, column, language, limit, raw)
+
+
+def load_known_keys():
+    """Primary keys already stored, one query per table, for crawl-time existence checks"""
+    return {
+        model: {key for key, in model.select(model._meta.primary_key).tuples()}
+        for model in (Problem, Submission, Tag)
+    }
+
+
+def _add_hot_query_indexes(db):
+    """indexes for the submissions of a problem and for the problems of a tag"""
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "submission_slug_id_created" '
+                   'ON "submission" ("slug_id", "created" DESC, "id")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "problemtag_tag_id_problem_id" ON "problemtag" ("tag_id", "problem_id")')
+
+
+def _compress_text_columns(db):
+    """compress the stored problem descriptions, solutions and submission sources"""
+    compress_columns(db, [Problem.description, Solution.content, Submission.source])
+
+
+def _add_search_index(db):
+    """full-text search index over problems, solutions and submissions"""
+    search.create_index(db)
+
+
+# (schema version, migration) in order; append new ones, never edit or reorder applied ones
+MIGRATIONS = [
+    (1, _add_hot_query_indexes),
+    (2, _compress_text_columns),
+    (3, _add_search_index),
+]
+
+
+TABLES = [Problem, Solution, Submission, Tag, ProblemTag]
+
+
+def schema_is_current():
+    """True when create_tables() has nothing to create or migrate"""
+    with database.connection_context():
+        return all(model.table_exists() for model in TABLES) and schema_version(database) >= MIGRATIONS[-1][0]
+
+
 def create_tables():
-    with database:
-        database.create_tables([Problem, Solution, Submission, Tag, ProblemTag])
+    # no surrounding transaction: every migration commits on its own and VACUUM cannot run in one
+    with database.connection_context():
+        database.create_tables(TABLES)
+        # existing databases upgrade in place, see MIGRATIONS
+        migrate(database, MIGRATIONS)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,471 @@
+import asyncio
+import functools
+import json
+import os.path
+import pickle
+import time
+from sys import exit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from peewee import chunked
+from requests.cookies import RequestsCookieJar
+from selenium import webdriver
+from selenium.webdriver.support.ui import WebDriverWait
+
+from utils import destructure, do, get, make_rate_limiter, make_retry_policy, throttle, parser as conf
+from cache import cache_session, make_response_cache
+from writer import DatabaseWriter
+from metrics import instrument, metrics
+
+
+class SiteProfile:
+    """What the crawl engine needs to know about one LeetCode site.
+
+    url:            the site, used for the login page and the Host/Referer headers
+    database:       the module holding its models (database or database_cn)
+    section:        its project.conf section for the rate limiter and retry policy
+    db_section:     its [DB*] section; the response cache lives under its path
+    cookie_path:    where login() keeps the session cookies
+    fields:         question field -> key in the site's GraphQL answer, for title, description and tag_name
+    skip_paid_only: leave out paid-only problems of the problem list
+    incremental:    skip problems without new activity in the submission feed, needs the SyncState table
+    """
+
+    def __init__(self, url, database, section, db_section, cookie_path, fields,
+                 session_cookie="LEETCODE_SESSION", skip_paid_only=False, incremental=False):
+        self.url = url
+        self.host = urlsplit(url).netloc
+        self.database = database
+        self.section = section
+        self.db_section = db_section
+        self.cookie_path = cookie_path
+        self.fields = fields
+        # set by the site as soon as a login goes through
+        self.session_cookie = session_cookie
+        self.skip_paid_only = skip_paid_only
+        self.incremental = incremental
+
+
+class CrawlEngine:
+    """The site-agnostic part of the crawlers: login, the thread and async engines, rate
+    limiting, retries, the response cache, the single database writer and incremental sync.
+
+    A site's crawler subclasses it with its SiteProfile and implements the steps run for
+    each accepted problem: fetch_problem(slug, accepted) and fetch_solution(slug) for new
+    problems, fetch_submission(slug) for all of them, and optionally
+    fetch_problems_batch(slugs, accepted) to prefetch new problems batch_size at a time.
+    """
+
+    def __init__(self, profile, max_workers=5, max_in_flight=None, batch_size=1, offline=False,
+                 full_sync_days=30, activity_max_pages=50, submission_page_size=20, submission_max_pages=10,
+                 base_url=None):
+        self.profile = profile
+        self.db = profile.database
+        # create an http session
+        self.session = requests.Session()
+        # offline runs rebuild the database from the response cache and never log in
+        self.offline = offline
+        self.browser = None  # only started by login() when the saved cookies are missing or expired
+        # the site to crawl, overridden to point the crawler at a local stand-in server
+        self.base_url = base_url or profile.url
+        self.graphql_url = f"{self.base_url}/graphql"
+        self.max_workers = max_workers
+        # global limit on concurrent requests for the async engine, defaults to one per worker
+        self.max_in_flight = max_in_flight or max_workers
+        # number of new problems fetched per GraphQL request, 1 disables batching
+        self.batch_size = max(1, batch_size)
+        # problems are re-checked at least every full_sync_days even without new activity,
+        # and the submission feed is read at most activity_max_pages pages back
+        self.full_sync_days = full_sync_days
+        self.activity_max_pages = activity_max_pages
+        # submissions are paged submission_page_size at a time, at most submission_max_pages per problem
+        self.submission_page_size = submission_page_size
+        self.submission_max_pages = submission_max_pages
+        # keep one pooled connection per in-flight request
+        adapter = HTTPAdapter(pool_maxsize=max(self.max_workers, self.max_in_flight))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # per-operation request counts, latency, bytes and HTTP errors, see metrics.py
+        instrument(self.session, metrics)
+        # one requests-per-second budget shared by every worker, see [Crawler] in project.conf
+        self.limiter = make_rate_limiter(profile.section)
+        throttle(self.session, self.limiter)
+        # backoff, error classification and a circuit breaker shared by every worker
+        self.retry = make_retry_policy(profile.section)
+        # on-disk response cache in front of the network, see [Cache] in project.conf
+        if offline or conf.getboolean("Cache", "enabled", fallback=False):
+            self.cache = make_response_cache(db_section=profile.db_section)
+            cache_session(self.session, self.cache, offline)
+        else:
+            self.cache = None
+        self.writer = None  # set while fetch_accepted_problems runs, see _write
+        self.db_write_time = 0.0
+        self.known = None  # primary keys already stored, loaded at crawl start, see _exists
+        self.problem_ids = {}  # slug -> id of the problems stored by _save_problem
+        self.problem_slugs = {}  # and back, to tell which problem a row belongs to
+        self.session.headers.update(
+            {
+                'Host': profile.host,
+                'Cache-Control': 'max-age=0',
+                'Upgrade-Insecure-Requests': '1',
+                'Referer': f'{profile.url}/accounts/login/',
+                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.98 Safari/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+                'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6',
+                'Connection': 'keep-alive'
+            }
+        )
+
+    def login(self, timeout=120):
+        """Reuse the cookies saved in the profile's cookie_path if the site still accepts them, otherwise
+        log in through a browser (started only then) and save the new cookies"""
+        if os.path.isfile(self.profile.cookie_path):
+            with open(self.profile.cookie_path, 'rb') as f:
+                self._use_cookies(pickle.load(f))
+            if self._signed_in():
+                print("[+] Reusing saved cookies")
+                return
+            print("[*] Saved cookies expired")
+
+        print("[*] Starting browser login..., please fill the login form")
+        print(f"[*] You have {timeout} seconds to log in to your LeetCode account")
+        self.browser = webdriver.Edge()
+        try:
+            self.browser.get(f"{self.profile.url}/accounts/login")
+            # the session cookie is set as soon as the login goes through, poll for it
+            # instead of waiting a fixed time for the session to settle
+            WebDriverWait(self.browser, timeout, poll_frequency=0.5).until(
+                lambda driver: driver.get_cookie(self.profile.session_cookie)
+            )
+            browser_cookies = self.browser.get_cookies()
+            print(f"[+] Login successfully, obtained {len(browser_cookies)} cookies")
+        except Exception as e:
+            print(f"[-] Login Failed: {e}, please try again")
+            exit()
+        finally:
+            self.browser.quit()
+            self.browser = None
+
+        self._use_cookies(browser_cookies)
+        if not self._signed_in():
+            print("[-] Login Failed: the site did not accept the new cookies, please try again")
+            exit()
+        with open(self.profile.cookie_path, 'wb') as f:
+            pickle.dump(browser_cookies, f)
+
+    def _use_cookies(self, browser_cookies):
+        cookies = RequestsCookieJar()
+        for item in browser_cookies:
+            cookies.set(item['name'], item['value'])
+
+            if item['name'] == 'csrftoken':
+                self.session.headers.update({
+                    "x-csrftoken": item['value']
+                })
+
+        self.session.cookies.update(cookies)
+
+    def _signed_in(self):
+        """One small GraphQL request telling whether the session cookies are still valid"""
+        try:
+            response = self.session.post(self.graphql_url, json={
+                "operationName": "globalData",
+                "variables": {},
+                "query": "query globalData { userStatus { isSignedIn username } }"
+            }, timeout=10)
+            status = get(response.json(), "data.userStatus") or {}
+        except Exception as e:
+            print(f"[-] Could not check the saved session: {e}")
+            return False
+        if status.get("isSignedIn"):
+            print(f"[+] Signed in as {status.get('username')}")
+            return True
+        return False
+
+    def _steps(self, slug, is_new, fetch_details=None):
+        """(method, args) of each request for a problem, in order: problem and solution when
+        fetch_details (defaults to is_new; False when a batch already fetched them), then submission"""
+        if fetch_details is None:
+            fetch_details = is_new
+        steps = [(self.fetch_problem, [slug, True]), (self.fetch_solution, [slug])] if fetch_details else []
+        # always try to update submission
+        return steps + [(self.fetch_submission, [slug])]
+
+    def _process_problem(self, slug, is_new, fetch_details=None):
+        """Process a single problem: fetch problem, solution, and submission."""
+        try:
+            for func, args in self._steps(slug, is_new, fetch_details):
+                do(func, args=args, policy=self.retry)
+            return True, slug, is_new
+        except Exception as e:
+            print(f"[!] Error processing {slug}: {e}")
+            return False, slug, is_new
+
+    async def _process_problem_async(self, slug, is_new, fetch_details=None):
+        """_process_problem for the async engine, waiting on the event loop instead of in a thread"""
+        try:
+            for func, args in self._steps(slug, is_new, fetch_details):
+                await self.retry.call_async(self._run_request, func, *args)
+            return True, slug, is_new
+        except Exception as e:
+            print(f"[!] Error processing {slug}: {e}")
+            return False, slug, is_new
+
+    async def _run_request(self, func, *args):
+        # the rate limiter token is taken right before sending, so an open breaker or a
+        # Retry-After pause since the last attempt holds the request back
+        while True:
+            wait = self.retry.breaker.remaining() if self.retry.breaker is not None else 0
+            if wait <= 0:
+                wait = self.limiter.try_acquire()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        return await self._loop.run_in_executor(
+            self._io_pool, functools.partial(self.limiter.call_reserved, func, *args)
+        )
+
+    async def _crawl_async(self, problems_to_process):
+        self._loop = asyncio.get_running_loop()
+        # max_in_flight workers take problems from one shared iterator, each is one request in flight
+        pending = iter(problems_to_process)
+        results = []
+
+        async def worker():
+            for problem in pending:
+                results.append(await self._process_problem_async(*problem))
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as self._io_pool:
+            await asyncio.gather(*(worker() for _ in range(self.max_in_flight)))
+        return results
+
+    def _crawl_threads(self, problems_to_process):
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Submit all tasks
+            future_to_problem = {executor.submit(self._process_problem, *problem): problem
+                                for problem in problems_to_process}
+
+            # Process completed tasks
+            for future in as_completed(future_to_problem):
+                slug, is_new, _ = future_to_problem[future]
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"[!] Exception for {slug}: {e}")
+                    results.append((False, slug, is_new))
+        return results
+
+    def fetch_recent_activity(self, since):
+        """Slugs with any submission at or after `since` (unix seconds), read from the
+        account-wide submission feed newest first. None if the feed could not be read back that far."""
+        slugs = set()
+        offset, last_key = 0, ""
+        for _ in range(self.activity_max_pages):
+            resp = self.session.get(
+                f"{self.base_url}/api/submissions/",
+                params={"offset": offset, "limit": 20, "lastkey": last_key}
+            )
+            body = json.loads(resp.content.decode('utf-8'))
+            submissions = body.get('submissions_dump')
+            if submissions is None:
+                return None
+            for sub in submissions:
+                if int(sub['timestamp']) < since:
+                    return slugs
+                slugs.add(sub['title_slug'])
+            if not body.get('has_next'):
+                return slugs
+            offset += len(submissions)
+            last_key = body.get('last_key') or ""
+        print(f"[!] Submission feed goes back further than {self.activity_max_pages} pages")
+        return None
+
+    def _drop_unchanged(self, problems_to_process):
+        """Drop existing problems that were checked before and have no submission activity
+        since, according to the submission feed; unchanged problems count as checked now"""
+        states = self.db.load_sync_state()
+        now = int(time.time())
+        stale_after = now - self.full_sync_days * 86400
+        candidates = [slug for slug, is_new, _ in problems_to_process
+                      if not is_new and slug in states and states[slug].checked_at >= stale_after]
+        if not candidates:
+            return problems_to_process
+
+        # a small margin covers clock skew between us and LeetCode
+        since = min(states[slug].checked_at for slug in candidates) - 3600
+        try:
+            active = self.fetch_recent_activity(since)
+        except Exception as e:
+            print(f"[!] Cannot read the submission feed, checking every problem: {e}")
+            active = None
+        if active is None:
+            return problems_to_process
+
+        unchanged = {slug for slug in candidates if slug not in active}
+        for chunk in chunked(list(unchanged), 500):
+            self.db.SyncState.update(checked_at=now).where(self.db.SyncState.slug.in_(chunk)).execute()
+        print(f"[*] Skipping {len(unchanged)} problems without new submissions")
+        return [problem for problem in problems_to_process if problem[0] not in unchanged]
+
+    def _crawl(self, problems_to_process, engine):
+        # fetch details of new problems in aliased batches, failures fall back to single queries
+        new_slugs = [slug for slug, is_new, _ in problems_to_process if is_new]
+        if self.batch_size > 1 and new_slugs and hasattr(self, "fetch_problems_batch"):
+            batched = self._prefetch_new_problems(new_slugs)
+            problems_to_process = [(slug, is_new, is_new and slug not in batched)
+                                   for slug, is_new, _ in problems_to_process]
+
+        if engine == "async":
+            print(f"[*] Processing {len(problems_to_process)} problems with {self.max_in_flight} requests in flight...")
+            return asyncio.run(self._crawl_async(problems_to_process))
+        print(f"[*] Processing {len(problems_to_process)} problems with {self.max_workers} workers...")
+        return self._crawl_threads(problems_to_process)
+
+    def fetch_accepted_problems(self, engine="threads"):
+        """Crawl every accepted problem.
+
+        engine: "threads" runs each problem on a ThreadPoolExecutor with max_workers threads,
+                "async" multiplexes all problems on one event loop with at most max_in_flight requests
+        """
+        with metrics.stage("list"):
+            response = self.session.get(f"{self.base_url}/api/problems/all/")
+            all_problems = json.loads(response.content.decode('utf-8'))
+
+            # one query per table instead of a lookup per problem, submission and tag
+            self.known = self.db.load_known_keys()
+
+            # Prepare list of problems to process
+            problems_to_process = []
+            total_ac = 0
+
+            for item in all_problems['stat_status_pairs']:
+                if item['status'] == 'ac':
+                    if self.profile.skip_paid_only and item['paid_only']:
+                        continue
+                    total_ac += 1
+                    id, slug = destructure(item['stat'], "question_id", "question__title_slug")
+                    is_new = not self._exists(self.db.Problem, id)
+                    problems_to_process.append((slug, is_new, is_new))
+
+            print(f"[*] Total AC problems: {total_ac}")
+
+            # skip problems whose submissions cannot have changed since they were last checked
+            if self.profile.incremental:
+                problems_to_process = self._drop_unchanged(problems_to_process)
+
+        # workers only fetch and parse, the writer thread owns all database writes
+        with DatabaseWriter(on_written=self._mark_known) as self.writer:
+            results = self._crawl(problems_to_process, engine)
+        self.db_write_time += self.writer.write_time
+        metrics.add_stage("db_write", self.writer.write_time)
+        # a problem whose rows did not make it into the database has failed after all
+        unwritten = self.writer.failed
+        self.writer = None
+        if unwritten:
+            print(f"[!] Could not store {len(unwritten)} problems: {', '.join(sorted(unwritten))}")
+            results = [(success and slug not in unwritten, slug, was_new) for success, slug, was_new in results]
+
+        # Tally results
+        new_problems = 0
+        existing_problems = 0
+        successful = 0
+        failed = 0
+
+        for success, _, was_new in results:
+            if success:
+                successful += 1
+                if was_new:
+                    new_problems += 1
+                else:
+                    existing_problems += 1
+            else:
+                failed += 1
+        
+        if self.cache is not None:
+            print(f"[*] Response cache: {self.cache.hits} hits, {self.cache.misses} misses")
+            metrics.count("cache_hits", value=self.cache.hits)
+            metrics.count("cache_misses", value=self.cache.misses)
+        print(f"[*] New problems added: {new_problems}")
+        print(f"[*] Existing problems (submissions updated): {existing_problems}")
+        print(f"[*] Successful: {successful}, Failed: {failed}")
+
+    def _prefetch_new_problems(self, slugs):
+        """Fetch new problems batch_size at a time; returns the set of slugs that made it"""
+        batches = [slugs[i:i + self.batch_size] for i in range(0, len(slugs), self.batch_size)]
+        fetched = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_problems_batch, batch, True): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    fetched.update(future.result())
+                except Exception as e:
+                    print(f"[!] Batch failed, falling back to single queries: {e}")
+        print(f"[*] Batched {len(fetched)}/{len(slugs)} new problems in {len(batches)} requests")
+        return fetched
+
+    def _exists(self, model, key):
+        """Check the in-memory key index when it is loaded, the database otherwise"""
+        field = model._meta.primary_key
+        if self.known is not None and model in self.known:
+            return field.adapt(key) in self.known[model]
+        return model.get_or_none(field == key) is not None
+
+    def _write(self, model, **row):
+        """Insert or replace a row, through the single writer when a crawl is running"""
+        if self.writer is not None:
+            self.writer.put(model, row, self._owner(model, row))
+        else:
+            model.insert(**row).on_conflict_replace().execute()
+            self._mark_known(model, row)
+
+    def _mark_known(self, model, row):
+        """Add the key of a row that has been written to the in-memory key index"""
+        if self.known is not None and model in self.known:
+            field = model._meta.primary_key
+            self.known[model].add(field.adapt(row[field.name]))
+
+    def _owner(self, model, row):
+        """Slug of the problem a row belongs to, None for tags, which problems share"""
+        if model is self.db.Tag:
+            return None
+        if "slug" in row:
+            return row["slug"]
+        return self.problem_slugs.get(row["problem"])
+
+    def _save_problem(self, slug, question, accepted):
+        """Store a question of the site's GraphQL answer; profile.fields says which keys
+        hold the title, description and tag names (translated ones on leetcode.cn)"""
+        fields = self.profile.fields
+        self.problem_ids[slug] = question['questionId']
+        self.problem_slugs[question['questionId']] = slug
+        self._write(
+            self.db.Problem,
+            id=question['questionId'], display_id=question['questionFrontendId'], title=question[fields["title"]],
+            level=question["difficulty"], slug=slug, description=question[fields["description"]],
+            accepted=accepted
+        )
+
+        for item in question['topicTags']:
+            if not self._exists(self.db.Tag, item['slug']):
+                self._write(
+                    self.db.Tag,
+                    name=item[fields["tag_name"]],
+                    slug=item['slug']
+                )
+
+            self._write(
+                self.db.ProblemTag,
+                problem=question['questionId'],
+                tag=item['slug']
+            )
+
+    def _problem_id(self, slug):
+        """Id of a problem stored in this run (possibly still queued in the writer) or before"""
+        if slug not in self.problem_ids:
+            self.problem_ids[slug] = self.db.Problem.get(self.db.Problem.slug == slug).id
+            self.problem_slugs[self.problem_ids[slug]] = slug
+        return self.problem_ids[slug]
@@ -1,15 +1,203 @@
-from database import create_tables
-from crawler import LeetCodeCrawler
-from renderer import render_anki
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
 
-# create database
-create_tables()
+import profiling
+from metrics import metrics
+from utils import parser as conf
 
-# start crawler with parallel processing (default: 5 workers)
-# Increase max_workers for faster processing (e.g., 10), but be careful not to trigger rate limits
-worker = LeetCodeCrawler(max_workers=8)
-worker.login()
-worker.fetch_accepted_problems()
+# config sections and modules of each site; modules are imported by the subcommands that need
+# them, so render and status runs never load selenium or requests
+SITES = {
+    "com": {"db": "DB", "anki": "Anki", "crawler": "crawler", "database": "database", "renderer": "renderer"},
+    "cn": {"db": "DB_CN", "anki": "Anki_CN", "crawler": "crawler_cn", "database": "database_cn",
+           "renderer": "renderer_cn"},
+}
 
-# render anki
-render_anki()
\ No newline at end of file
+
+def load(site, module):
+    return importlib.import_module(SITES[site][module])
+
+
+def open_database(site):
+    """The site's database module for a read-only subcommand. It is not created or migrated
+    here: that rewrites the file and would block a crawl running meanwhile."""
+    database = load(site, "database")
+    if not database.schema_is_current():
+        sys.exit("[-] Database missing or its schema out of date, run crawl or render to upgrade it")
+    return database
+
+
+def crawl(args):
+    database = load(args.site, "database")
+    database.create_tables()
+
+    if args.site == "cn":
+        if args.offline:
+            sys.exit("[-] --offline is only supported for leetcode.com")
+        worker = load(args.site, "crawler").LeetCodeCrawler(
+            max_workers=conf.getint("Crawler_CN", "max_workers", fallback=4),
+            max_in_flight=conf.getint("Crawler_CN", "max_in_flight", fallback=4)
+        )
+        worker.login()
+        worker.fetch_accepted_problems(engine=conf.get("Crawler_CN", "engine", fallback="threads"))
+        return
+
+    # start crawler with parallel processing (see [Crawler] in project.conf)
+    # Increase max_workers / max_in_flight for faster processing, but be careful not to trigger rate limits
+    worker = load(args.site, "crawler").LeetCodeCrawler(
+        max_workers=conf.getint("Crawler", "max_workers", fallback=8),
+        max_in_flight=conf.getint("Crawler", "max_in_flight", fallback=8),
+        batch_size=conf.getint("Crawler", "batch_size", fallback=1),
+        offline=args.offline,
+        full_sync_days=conf.getint("Crawler", "full_sync_days", fallback=30),
+        activity_max_pages=conf.getint("Crawler", "activity_max_pages", fallback=50),
+        submission_page_size=conf.getint("Crawler", "submission_page_size", fallback=20),
+        submission_max_pages=conf.getint("Crawler", "submission_max_pages", fallback=10)
+    )
+    if not args.offline:
+        worker.login()
+    worker.fetch_accepted_problems(engine=conf.get("Crawler", "engine", fallback="threads"))
+
+
+def render(args):
+    load(args.site, "database").create_tables()
+    load(args.site, "renderer").render_anki()
+
+
+def status(args):
+    """What is stored locally; reads the database only, never the network"""
+    database = open_database(args.site)
+    print(f"[*] Database: {database.database.database}")
+    for model in (database.Problem, database.Tag, database.Submission, database.Solution):
+        print(f"    {model.__name__ + 's':<12} {model.select().count():>8}")
+
+    if hasattr(database, "SyncState"):
+        checked = database.SyncState.select().order_by(database.SyncState.checked_at.desc()).first()
+        if checked is not None:
+            print(f"[*] Last synced: {checked.slug} at {time.strftime('%Y-%m-%d %H:%M', time.localtime(checked.checked_at))}")
+
+    cache = os.path.join(conf.get(SITES[args.site]["db"], "path"), "cache")
+    if os.path.isdir(cache):
+        # entries are stored as <key[:2]>/<key>.json, see cache.py
+        sizes = [os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(cache) for name in names]
+        print(f"[*] Response cache: {len(sizes)} entries, {sum(sizes) / 1e6:.1f} MB")
+
+    if args.query_plans and hasattr(database, "query_plans"):
+        print("[*] Query plans of the hot queries:")
+        plans = database.query_plans()
+        for name, lines, backed in plans:
+            print(f"    {'ok ' if backed else 'NOT index-backed'} {name}")
+            for line in lines:
+                print(f"        {line}")
+        if not all(backed for _, _, backed in plans):
+            sys.exit("[-] Some hot queries are not index-backed")
+
+    section = SITES[args.site]["anki"]
+    for key in ("output", "delta_output"):
+        path = conf.get(section, key, fallback="")
+        if path and os.path.exists(path):
+            modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(path)))
+            print(f"[*] {path}: {os.path.getsize(path) / 1e6:.1f} MB, written {modified}")
+
+
+def export(args):
+    """Dump every problem with its tags and submissions as JSON lines"""
+    database = open_database(args.site)
+    Problem, ProblemTag, Tag, Submission = database.Problem, database.ProblemTag, database.Tag, database.Submission
+
+    tags = {}
+    for row in ProblemTag.select(ProblemTag.problem, Tag.slug, Tag.name).join(Tag).dicts():
+        tags.setdefault(row["problem"], []).append({"slug": row["slug"], "name": row["name"]})
+    submissions = {}
+    query = Submission.select(Submission.slug, Submission.language, Submission.source, Submission.created)
+    for row in query.order_by(Submission.created).dicts():
+        submissions.setdefault(row["slug"], []).append({
+            "language": row["language"], "source": row["source"], "created": str(row["created"])
+        })
+
+    out = open(args.output, "w", encoding="utf-8") if args.output != "-" else sys.stdout
+    count = 0
+    try:
+        for problem in Problem.select().order_by(Problem.display_id).dicts().iterator():
+            problem["tags"] = tags.get(problem["id"], [])
+            problem["submissions"] = submissions.get(problem["slug"], [])
+            out.write(json.dumps(problem, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+            print(f"[*] Exported {count} problems to {args.output}")
+
+
+def search(args):
+    """Full-text search of the problems, their solutions and submissions"""
+    database = open_database(args.site)
+    text = " ".join(args.query)
+    try:
+        results = database.search_problems(text, args.column, args.language, args.limit, args.match)
+    except database.OperationalError as e:
+        # e.g. a --match query that is not valid FTS5 syntax
+        sys.exit(f"[-] Search failed: {e}")
+    where = f" in {args.column}" if args.column else ""
+    language = f" with {args.language} submissions" if args.language else ""
+    print(f"[*] {len(results)} problems match {text!r}{where}{language}")
+    for result in results:
+        print(f"    {result['display_id']:>5}  {result['title']} ({result['slug']})")
+        print(f"           {' '.join(result['snippet'].split())}")
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description="Crawl accepted LeetCode problems and render an Anki deck")
+    args.add_argument("--site", choices=SITES, default="com", help="leetcode.com or leetcode.cn")
+    args.add_argument("--offline", action="store_true",
+                      help="rebuild the database from the response cache only, without logging in")
+    args.add_argument("--profile", action="store_true",
+                      help="write cProfile stats (.pstats) and sampled stacks (.collapsed) of each stage")
+    args.add_argument("--profile-dir", default="./data/profile", help="where --profile writes (default: %(default)s)")
+    args.add_argument("--profile-memory", action="store_true",
+                      help="with --profile, also write a tracemalloc diff of each stage")
+    commands = args.add_subparsers(dest="command", metavar="command",
+                                   help="crawl, render, status, export or search; without one, crawl then render")
+    command = commands.add_parser("crawl", help="log in and crawl accepted problems into the database")
+    command.add_argument("--offline", action="store_true", default=argparse.SUPPRESS,
+                         help="rebuild the database from the response cache only, without logging in")
+    commands.add_parser("render", help="render the Anki deck from the database, without logging in")
+    command = commands.add_parser("status", help="show what the database, response cache and deck contain")
+    command.add_argument("--query-plans", action="store_true",
+                         help="also check that the hot queries are index-backed (EXPLAIN QUERY PLAN)")
+    command = commands.add_parser("export", help="write problems, tags and submissions as JSON lines")
+    command.add_argument("-o", "--output", default="-", help="output file, - for stdout (default)")
+    command = commands.add_parser("search", help="full-text search of problems, solutions and submissions")
+    command.add_argument("query", nargs="+", help="words that must all occur")
+    command.add_argument("--in", dest="column", choices=["title", "description", "solution", "submissions"],
+                         help="only search this part of each problem")
+    command.add_argument("--language", help="only problems with a submission in this language, e.g. python")
+    command.add_argument("--limit", type=int, default=20, help="at most this many results (default: %(default)s)")
+    command.add_argument("--match", action="store_true",
+                         help="the query is an FTS5 expression, e.g. '\"monotonic stack\" NOT heap'")
+    args = args.parse_args(argv)
+
+    if args.command in ("status", "export", "search"):
+        {"status": status, "export": export, "search": search}[args.command](args)
+        return
+
+    if args.profile:
+        profiling.enable(args.profile_dir, memory=args.profile_memory)
+    try:
+        if args.command in (None, "crawl"):
+            with metrics.stage("crawl"), profiling.stage("crawl"):
+                crawl(args)
+        if args.command in (None, "render"):
+            with metrics.stage("render"), profiling.stage("render"):
+                render(args)
+    finally:
+        # written even when a stage fails, that run is the one worth looking at
+        metrics.write(conf.get("Metrics", "json", fallback=""), conf.get("Metrics", "prometheus", fallback=""))
+
+
+if __name__ == '__main__':
+    main()
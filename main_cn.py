@@ -1,14 +1,7 @@
-from database_cn import create_tables
-from crawler_cn import LeetCodeCrawler
-from renderer_cn import render_anki
+import sys
 
-# create database
-create_tables()
+from main import main
 
-# start crawler
-worker = LeetCodeCrawler()
-worker.login()
-worker.fetch_accepted_problems()
-
-# render anki
-render_anki()
\ No newline at end of file
+# same as `python main.py --site cn`
+if __name__ == '__main__':
+    main(["--site", "cn"] + sys.argv[1:])
@@ -0,0 +1,196 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets, the last one catches everything
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Metrics:
+    """Counters, latency histograms and stage timings of one run, safe to update from any thread.
+
+    Counters and histograms are keyed by (name, operation); an operation is a GraphQL
+    operationName or a REST path. Stage times are summed over every call, so with several
+    workers a stage can add up to more than the run's wall time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.stages = {}
+
+    def count(self, name, operation="", value=1):
+        with self.lock:
+            key = (name, operation)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, operation, seconds):
+        with self.lock:
+            histogram = self.histograms.get((name, operation))
+            if histogram is None:
+                histogram = self.histograms[(name, operation)] = {
+                    "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0
+                }
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def add_stage(self, stage, seconds, calls=1):
+        with self.lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + calls)
+
+    def take(self):
+        """Return and reset the counters and stage times, e.g. to ship them from a worker
+        process to the parent, which adds them back with merge()"""
+        with self.lock:
+            taken = {"counters": self.counters, "stages": self.stages}
+            self.counters, self.stages = {}, {}
+        return taken
+
+    def merge(self, taken):
+        for (name, operation), value in taken["counters"].items():
+            self.count(name, operation, value)
+        for stage, (seconds, calls) in taken["stages"].items():
+            self.add_stage(stage, seconds, calls)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        """Decorator form of stage()"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "counters": [
+                    {"name": name, "operation": operation, "value": value}
+                    for (name, operation), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {"name": name, "operation": operation, "le": list(LATENCY_BUCKETS[:-1]) + ["+Inf"],
+                     "buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                    for (name, operation), h in sorted(self.histograms.items())
+                ],
+                "stages": {stage: {"seconds": seconds, "calls": calls}
+                           for stage, (seconds, calls) in sorted(self.stages.items())},
+            }
+
+    def prometheus(self, prefix="leetcode_anki"):
+        """The snapshot in the Prometheus text exposition format, for node_exporter's textfile collector"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def label(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        seen = set()
+        for counter in snapshot["counters"]:
+            metric = f"{prefix}_{counter['name']}_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f'{metric}{{operation="{label(counter["operation"])}"}} {counter["value"]}')
+
+        for histogram in snapshot["histograms"]:
+            metric = f"{prefix}_{histogram['name']}_seconds"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            operation = label(histogram["operation"])
+            cumulative = 0
+            for bound, count in zip(histogram["le"], histogram["buckets"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{operation="{operation}"}} {histogram["sum"]:.6f}')
+            lines.append(f'{metric}_count{{operation="{operation}"}} {histogram["count"]}')
+
+        lines.append(f"# TYPE {prefix}_stage_seconds gauge")
+        for stage, value in snapshot["stages"].items():
+            lines.append(f'{prefix}_stage_seconds{{stage="{label(stage)}"}} {value["seconds"]:.6f}')
+        lines.append(f"# TYPE {prefix}_stage_calls gauge")
+        for stage, value in snapshot["stages"].items():
+            lines.append(f'{prefix}_stage_calls{{stage="{label(stage)}"}} {value["calls"]}')
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {snapshot['finished']:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None):
+        """Write the JSON and/or Prometheus files; each is written to a temporary file and
+        renamed, so a collector never reads half a file"""
+        if json_path:
+            _write_atomic(json_path, json.dumps(self.snapshot(), indent=2))
+            print(f"[*] Metrics written to {json_path}")
+        if prometheus_path:
+            _write_atomic(prometheus_path, self.prometheus())
+            print(f"[*] Metrics written to {prometheus_path}")
+
+
+def _write_atomic(path, content):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def instrument(session, metrics):
+    """Record count, latency, bytes sent/received and HTTP errors of every request that goes
+    through a requests.Session, per operation. Wrap the session before throttle() so the
+    rate limiter's waiting is not counted as latency."""
+    from cache import ResponseCache
+
+    request = session.request
+
+    def measured(method, url, *args, **kwargs):
+        data = kwargs.get("data")
+        if data is None and kwargs.get("json") is not None:
+            data = json.dumps(kwargs["json"])
+        operation, _ = ResponseCache.describe(method, url, data)
+        metrics.count("requests", operation)
+        if data:
+            metrics.count("bytes_sent", operation, len(data))
+        started = time.perf_counter()
+        try:
+            resp = request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.count("request_errors", operation)
+            raise
+        finally:
+            metrics.observe("request_latency", operation, time.perf_counter() - started)
+        metrics.count("bytes_received", operation, len(resp.content))
+        if resp.status_code == 429:
+            metrics.count("http_429", operation)
+        elif resp.status_code >= 500:
+            metrics.count("http_5xx", operation)
+        return resp
+
+    session.request = measured
+    return session
+
+
+# the registry of the current process
+metrics = Metrics()
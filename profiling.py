@@ -0,0 +1,155 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+# before 3.12 a cProfile.Profile only sees its own thread; from 3.12 one sees them all
+PER_THREAD = sys.version_info < (3, 12)
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of every other thread every `interval` seconds and counts them,
+    for collapsed-stack ("flamegraph.pl" / speedscope) output"""
+
+    def __init__(self, interval=0.005):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.done.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                # this sampler and those of nested stages
+                if names.get(ident) == self.name:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Profiles named pipeline stages into `directory`:
+
+    <stage>.pstats      cProfile stats of the stage, from the calling thread and every thread
+                        started during it (e.g. the crawler's worker pools); processes of a
+                        render pool are not included
+    <stage>.collapsed   sampled stacks of all threads, one "frame;frame;... count" line per stack
+    <stage>.memory.txt  with memory=True, the top allocations of a tracemalloc snapshot diff
+    """
+
+    def __init__(self, directory, memory=False, top=30):
+        self.directory = directory
+        self.memory = memory
+        self.top = top
+        self.current = None  # cProfile.Profile of the innermost running stage
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        # stages nest (render contains package): the outer stage pauses while the inner one runs
+        outer = self.current
+        if outer is not None:
+            outer.disable()
+
+        before = None
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            before = tracemalloc.take_snapshot()
+
+        threads = []
+
+        def start_in_thread(frame, event, arg):
+            # runs once as the profile hook of each thread started during the stage,
+            # then enable() replaces it with that thread's own profiler
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiling tool is active; the thread runs on, unprofiled
+                sys.setprofile(None)
+                return
+            threads.append(profile)
+
+        # the sampler starts before the hook is installed, so it is not profiled itself
+        sampler = StackSampler()
+        sampler.start()
+        profile = self.current = cProfile.Profile()
+        if PER_THREAD:
+            threading.setprofile(start_in_thread)
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            sampler.stop()
+            if PER_THREAD:
+                threading.setprofile(None)
+            self.current = outer
+
+            stats = pstats.Stats(profile)
+            for thread_profile in threads:
+                # the threads have finished, create_stats only collects what they recorded
+                stats.add(thread_profile)
+            base = os.path.join(self.directory, name)
+            stats.dump_stats(base + ".pstats")
+            sampler.write(base + ".collapsed")
+            if before is not None:
+                self._write_memory(base + ".memory.txt", before)
+            print(f"[*] Profiled {name} ({elapsed:.2f}s) into {base}.pstats / .collapsed")
+
+            if outer is not None:
+                outer.enable()
+
+    def _write_memory(self, path, before):
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"traced now {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB\n\n")
+            for diff in after.compare_to(before, "lineno")[:self.top]:
+                f.write(f"{diff}\n")
+
+
+# the Profiler of this run, None unless enable() was called (main.py --profile)
+_profiler = None
+
+
+def enable(directory, memory=False):
+    global _profiler
+    _profiler = Profiler(directory, memory)
+    return _profiler
+
+
+@contextmanager
+def stage(name):
+    """Profile the block as stage `name` when profiling is enabled, otherwise do nothing"""
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.stage(name):
+            yield
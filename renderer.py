@@ -1,16 +1,38 @@
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
 import random
 import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
-from genanki import Model, Deck, Note, Package
+from genanki import Model, Deck, Note
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
 from markdown import markdown
+from peewee import chunked
+import pygments
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name, PythonLexer, JavascriptLexer
 from pygments.formatters import HtmlFormatter
 
-from database import Problem, Submission
+import profiling
+from metrics import metrics
+from database import HighlightedCode, create_tables, iter_render_rows, load_problem_tags, \
+    stage_rendered_notes, commit_rendered_notes, discard_rendered_notes
 from utils import parser as conf
 
 
+# used when project.conf sets no [Anki] deck_id; a fixed id lets Anki update the deck in place
+DECK_ID = 1597430139
+
+
 def random_id():
     return random.randrange(1 << 30, 1 << 31)
 
@@ -27,59 +49,69 @@ def markdown_to_html(content: str):
     return markdown(content, extensions=['mdx_math', 'toc', 'fenced_code', 'tables'])
 
 
-def code_to_html(source, language):
-    """Convert code to HTML with syntax highlighting using Pygments"""
-    # Map LeetCode language names to Pygments lexer names
-    language_map = {
-        'python': 'python',
-        'python3': 'python',
-        'javascript': 'javascript',
-        'js': 'javascript',
-        'java': 'java',
-        'cpp': 'cpp',
-        'c++': 'cpp',
-        'c': 'c',
-        'csharp': 'csharp',
-        'c#': 'csharp',
-        'ruby': 'ruby',
-        'swift': 'swift',
-        'golang': 'go',
-        'go': 'go',
-        'kotlin': 'kotlin',
-        'rust': 'rust',
-        'typescript': 'typescript',
-        'php': 'php',
-        'scala': 'scala',
-        'mysql': 'sql',
-        'mssql': 'sql',
-        'oraclesql': 'sql'
-    }
-    
-    # Get the appropriate lexer
-    lexer_name = language_map.get(language.lower(), 'python')
-    try:
-        lexer = get_lexer_by_name(lexer_name)
-    except:
-        lexer = PythonLexer()
-    
+# Map LeetCode language names to Pygments lexer names
+LANGUAGE_MAP = {
+    'python': 'python',
+    'python3': 'python',
+    'javascript': 'javascript',
+    'js': 'javascript',
+    'java': 'java',
+    'cpp': 'cpp',
+    'c++': 'cpp',
+    'c': 'c',
+    'csharp': 'csharp',
+    'c#': 'csharp',
+    'ruby': 'ruby',
+    'swift': 'swift',
+    'golang': 'go',
+    'go': 'go',
+    'kotlin': 'kotlin',
+    'rust': 'rust',
+    'typescript': 'typescript',
+    'php': 'php',
+    'scala': 'scala',
+    'mysql': 'sql',
+    'mssql': 'sql',
+    'oraclesql': 'sql'
+}
+
+
+def make_formatter():
     # Use HtmlFormatter with appropriate options for Anki
-    formatter = HtmlFormatter(
+    return HtmlFormatter(
         style='default',
         noclasses=False,
         cssclass='highlight',
         linenos=False
     )
-    
-    return highlight(source, lexer, formatter)
 
 
-def get_anki_model():
-    with open(conf.get("Anki", "front"), 'r') as f:
+def get_lexer(language):
+    # Get the appropriate lexer
+    lexer_name = LANGUAGE_MAP.get(language.lower(), 'python')
+    try:
+        return get_lexer_by_name(lexer_name)
+    except:
+        return PythonLexer()
+
+
+def code_to_html(source, language, formatter=None, lexer=None):
+    """Convert code to HTML with syntax highlighting using Pygments"""
+    return highlight(source, lexer or get_lexer(language), formatter or make_formatter())
+
+
+def read_templates(section="Anki"):
+    with open(conf.get(section, "front"), 'r') as f:
         front_template = f.read()
-    with open(conf.get("Anki", 'back'), 'r') as f:
+    with open(conf.get(section, 'back'), 'r') as f:
         back_template = f.read()
-    with open(conf.get("Anki", 'css'), 'r') as f:
+    with open(conf.get(section, 'css'), 'r') as f:
         css = f.read()
+    return front_template, back_template, css
+
+
+def get_anki_model(templates=None):
+    front_template, back_template, css = templates or read_templates()
 
     anki_model = Model(
         model_id=1048217874,
@@ -107,71 +139,358 @@ def get_anki_model():
     return anki_model
 
 
-def make_note(problem):
-    print(f"📓 Producing note for problem: {problem.title}...")
-    tags = ";".join([t.name for t in problem.tags])
-    tags_slug = ";".join([t.slug for t in problem.tags])
+class HighlightCache:
+    """Highlighted HTML keyed by sha256 of (source, lexer, Pygments version, formatter options):
+    an in-process LRU of `size` entries in front of the HighlightedCode table. New entries
+    are buffered and written in one transaction by flush()."""
+
+    def __init__(self, formatter, size=4096):
+        self.options = json.dumps(formatter.options, sort_keys=True, default=str)
+        self.size = size
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.loaded_all = False  # True once preload() found the whole table fits in memory
+
+    def preload(self):
+        """Fill the LRU from the table in one query, so a deck render doesn't look entries up one by one"""
+        for row in HighlightedCode.select().limit(self.size):
+            self._remember(row.key, row.html)
+        self.loaded_all = len(self.memory) < self.size
+
+    def key(self, source, lexer):
+        parts = [hashlib.sha256(source.encode("utf-8")).hexdigest(), lexer.name, pygments.__version__, self.options]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.loaded_all:
+            return None
+        row = HighlightedCode.get_or_none(HighlightedCode.key == key)
+        if row is not None:
+            self._remember(key, row.html)
+            return row.html
+        return None
+
+    def put(self, key, html):
+        self._remember(key, html)
+        self.pending[key] = html
+
+    def _remember(self, key, html):
+        self.memory[key] = html
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        if not self.pending:
+            return
+        rows = [{"key": key, "html": html} for key, html in self.pending.items()]
+        with HighlightedCode._meta.database.atomic():
+            for batch in chunked(rows, 100):
+                HighlightedCode.insert_many(batch).on_conflict_replace().execute()
+        self.pending = {}
+
+
+class RenderContext:
+    """Everything notes share, built once per render: the templates and CSS, the Anki model,
+    the Pygments formatter (whose stylesheet is generated when it is created), one lexer per
+    language and the highlighted-code cache"""
+
+    def __init__(self, section="Anki"):
+        self.templates = read_templates(section)
+        self.model = get_anki_model(self.templates)
+        self.formatter = make_formatter()
+        self.lexers = {}
+        self.highlights = HighlightCache(self.formatter)
+        # changes whenever a template, the CSS or the highlighting setup does, see record_hash
+        self.fingerprint = hashlib.sha256(
+            "\0".join(self.templates + (pygments.__version__, self.highlights.options)).encode("utf-8")
+        ).hexdigest()
+
+    def code_to_html(self, source, language):
+        key = language.lower()
+        if key not in self.lexers:
+            self.lexers[key] = get_lexer(language)
+        lexer = self.lexers[key]
+
+        cache_key = self.highlights.key(source, lexer)
+        html = self.highlights.get(cache_key)
+        if html is None:
+            metrics.count("highlights", "rendered")
+            with metrics.stage("highlight"):
+                html = code_to_html(source, language, self.formatter, lexer)
+            self.highlights.put(cache_key, html)
+        else:
+            metrics.count("highlights", "cached")
+        return html
+
+
+def record_hash(record, context):
+    """Hash of everything a note's fields are rendered from"""
+    return hashlib.sha256(f"{context.fingerprint}\0{sorted(record.items())!r}".encode("utf-8")).hexdigest()
+
+
+@metrics.timed("note")
+def note_fields(record, context):
+    print(f"📓 Producing note for problem: {record['title']}...")
+    tags = ";".join([name for name, _ in record["tags"]])
+    tags_slug = ";".join([slug for _, slug in record["tags"]])
 
-    # Get the latest submission only (sorted by created date)
+    # Render the latest submission only
     submission_html = ""
     try:
-        latest_submission = (
-            Submission.select()
-            .where(Submission.slug == problem.slug)
-            .order_by(Submission.created.desc())
-            .first()
-        )
-        
-        if latest_submission:
+        if record["submission"]:
+            source, language = record["submission"]
             # Decode unicode escapes in the source code
             source = re.sub(
                 r'(\\u[\s\S]{4})',
                 lambda x: x.group(1).encode("utf-8").decode("unicode-escape"),
-                latest_submission.source
+                source
             )
             # Add language label before the code
-            language_label = f'<div style="margin-bottom: 5px; color: #666; font-weight: bold;">Language: {latest_submission.language.title()}</div>'
-            submission_html = language_label + code_to_html(source, latest_submission.language)
+            language_label = f'<div style="margin-bottom: 5px; color: #666; font-weight: bold;">Language: {language.title()}</div>'
+            submission_html = language_label + context.code_to_html(source, language)
     except Exception as e:
         print(f"    ⚠️  No submission found: {e}")
         submission_html = "<p>No submission available</p>"
 
-    note = Note(
-        model=get_anki_model(),
-        fields=[
-            str(problem.display_id),
-            problem.title,
-            problem.slug,
-            problem.level,
-            problem.description,
-            tags,
-            tags_slug,
-            "",  # Empty solution field - we only show submission now
-            submission_html
-        ],
-        guid=str(problem.display_id),
-        sort_field=str(problem.display_id),
-        tags=[t.slug for t in problem.tags]
-    )
-    return note
+    return [
+        str(record["display_id"]),
+        record["title"],
+        record["slug"],
+        record["level"],
+        record["description"],
+        tags,
+        tags_slug,
+        "",  # Empty solution field - we only show submission now
+        submission_html
+    ]
 
 
-def render_anki():
-    problems = Problem.select().order_by(
-        Problem.display_id
+def build_note(record, fields, context):
+    return Note(
+        model=context.model,
+        fields=fields,
+        guid=str(record["display_id"]),
+        sort_field=str(record["display_id"]),
+        tags=[slug for _, slug in record["tags"]]
     )
 
-    anki_deck = Deck(
-        deck_id=random_id(),
-        name="LeetCode"
-    )
 
-    for problem in problems:
-        note = make_note(problem)
-        anki_deck.add_note(note)
+# per-process context of the render workers
+_worker_context = None
+
+
+def _init_worker():
+    global _worker_context
+    _worker_context = RenderContext()
+    _worker_context.highlights.preload()
+
+
+def _render_chunk(records):
+    fields = [note_fields(record, _worker_context) for record in records]
+    _worker_context.highlights.flush()
+    # the worker's stage times and counters travel back with the chunk
+    return fields, metrics.take()
+
+
+def row_record(row, tags):
+    """Plain, picklable copy of what a note needs from a row of database.iter_render_rows,
+    so fields can be rendered in another process"""
+    return {
+        "id": row["id"],
+        "display_id": row["display_id"],
+        "title": row["title"],
+        "slug": row["slug"],
+        "level": row["level"],
+        "description": row["description"],
+        "tags": [(t.name, t.slug) for t in tags],
+        "submission": (row["submission_source"], row["submission_language"])
+        if row["submission_language"] is not None else None,
+    }
+
+
+def render_stream(items, context, workers=1, chunk_size=50):
+    """For an iterable of (record, fields) pairs, where fields is None for records that need
+    rendering, yield (record, fields, rendered) in the same order. Records are read and
+    rendered chunk_size at a time, and at most 2 * workers chunks are pending in the
+    process pool, so memory stays bounded however many records there are."""
+    def chunks():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def merge(chunk, rendered):
+        rendered = iter(rendered)
+        for record, fields in chunk:
+            if fields is None:
+                yield record, next(rendered), True
+            else:
+                yield record, fields, False
+
+    if workers <= 1:
+        for chunk in chunks():
+            rendered = [note_fields(record, context) for record, fields in chunk if fields is None]
+            # like _render_chunk, so the new highlights don't pile up in memory until the end
+            context.highlights.flush()
+            yield from merge(chunk, rendered)
+        return
+
+    def result(future):
+        if future is None:
+            return []
+        fields, taken = future.result()
+        metrics.merge(taken)
+        return fields
+
+    pending = deque()
+    # spawned, not forked: a forked worker would inherit this process's open SQLite
+    # connection (iter_render_rows is reading through it) and write through it too
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=spawn, initializer=_init_worker) as executor:
+        for chunk in chunks():
+            todo = [record for record, fields in chunk if fields is None]
+            pending.append((chunk, executor.submit(_render_chunk, todo) if todo else None))
+            while len(pending) > 2 * workers:
+                chunk, future = pending.popleft()
+                yield from merge(chunk, result(future))
+        while pending:
+            chunk, future = pending.popleft()
+            yield from merge(chunk, result(future))
+
+
+class StreamingPackage:
+    """Writes an .apkg note by note instead of collecting a genanki Deck first: notes go
+    straight into the collection SQLite file (committed every `commit_every` notes), which
+    is zipped on close. `compression` is the zlib level of the archive, 0 stores it as-is
+    like genanki does."""
+
+    def __init__(self, path, deck_id, name, model, compression=0, commit_every=500):
+        self.path = path
+        self.deck_id = deck_id
+        self.compression = compression
+        self.commit_every = commit_every
+        self.count = 0
+
+        handle, self.dbfilename = tempfile.mkstemp(suffix=".anki2")
+        os.close(handle)
+        self.conn = sqlite3.connect(self.dbfilename)
+        self.cursor = self.conn.cursor()
+        self.timestamp = time.time()
+        self.id_gen = itertools.count(int(self.timestamp * 1000))
+
+        # the collection, deck and model rows, as Package.write_to_db writes them
+        self.cursor.executescript(APKG_SCHEMA)
+        self.cursor.executescript(APKG_COL)
+        deck = Deck(deck_id=deck_id, name=name)
+        deck.add_model(model)
+        deck.write_to_db(self.cursor, self.timestamp, self.id_gen)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(write=exc_type is None)
+
+    @metrics.timed("package")
+    def add_note(self, note):
+        note.write_to_db(self.cursor, self.timestamp, self.deck_id, self.id_gen)
+        self.count += 1
+        if self.count % self.commit_every == 0:
+            self.conn.commit()
+
+    @metrics.timed("package")
+    def close(self, write=True):
+        if self.conn is None:
+            return
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+        try:
+            if write:
+                # the counterpart of genanki's Package.write_to_file, profiled on its own
+                with profiling.stage("package_" + os.path.basename(self.path).split(".")[0]):
+                    method = zipfile.ZIP_DEFLATED if self.compression else zipfile.ZIP_STORED
+                    with zipfile.ZipFile(self.path, 'w', method, compresslevel=self.compression or None) as outzip:
+                        outzip.write(self.dbfilename, 'collection.anki2')
+                        outzip.writestr('media', json.dumps({}))
+        finally:
+            os.remove(self.dbfilename)
+
+
+def render_anki(workers=None):
+    """Render the deck, re-rendering only notes whose inputs changed since the last run
+    (see RenderedNote). Problems are streamed from the database and notes streamed into
+    the package, so memory stays flat however large the deck is. If [Anki] delta_output
+    is set, the changed and new notes are also written there as a small package for quick
+    re-imports."""
+    if workers is None:
+        workers = conf.getint("Anki", "workers", fallback=1)
+    create_tables()
+    tags = load_problem_tags()
+
+    context = RenderContext()
+    context.highlights.preload()
+
+    def items():
+        for row in iter_render_rows():
+            record = row_record(row, tags.get(row["id"], []))
+            digest = record_hash(record, context)
+            record["hash"] = digest
+            yield record, row["fields"] if row["input_hash"] == digest else None
+
+    deck_id = conf.getint("Anki", "deck_id", fallback=DECK_ID)
+    compression = conf.getint("Anki", "compression", fallback=0)
+    delta_path = conf.get("Anki", "delta_output", fallback="")
+    delta = None
+    changed, total, saved = 0, 0, []
+
+    # the rendered notes are staged and only recorded once both packages are written, or a
+    # failed run would leave them out of the next run's delta
+    try:
+        with StreamingPackage(conf.get("Anki", "output"), deck_id, "LeetCode", context.model, compression) as package:
+            for record, fields, rendered in render_stream(items(), context, workers):
+                note = build_note(record, fields, context)
+                package.add_note(note)
+                total += 1
+                if not rendered:
+                    continue
+
+                changed += 1
+                saved.append((record["id"], record["hash"], fields))
+                if len(saved) >= 500:
+                    stage_rendered_notes(saved)
+                    saved = []
+                if delta_path:
+                    if delta is None:
+                        delta = StreamingPackage(delta_path + ".part", deck_id, "LeetCode", context.model, compression)
+                    delta.add_note(note)
+        stage_rendered_notes(saved)
+        if delta is not None:
+            delta.close()
+            os.replace(delta.path, delta_path)
+    except BaseException:
+        discard_rendered_notes()
+        if delta is not None:
+            delta.close(write=False)
+            if os.path.exists(delta.path):
+                os.remove(delta.path)
+        raise
+    commit_rendered_notes()
+    print(f"[*] Rendered {changed} changed notes, reused {total - changed}")
 
-    path = conf.get("Anki", "output")
-    Package(anki_deck).write_to_file(path)
+    if delta is not None:
+        print(f"[*] Wrote {changed} changed notes to {delta_path}")
+    elif delta_path and os.path.exists(delta_path):
+        # nothing changed, don't leave an older delta around to be imported again
+        os.remove(delta_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+import html
+import re
+
+from compression import decompress
+
+# Full-text index over the problems: one FTS5 row per problem (rowid = problem id) holding its
+# title, description, solution, every submission and the submissions' languages.
+#
+# The index is an external-content FTS5 table over the view SOURCE, which decompresses the
+# stored text on the fly, so the text is not kept a second time, uncompressed. Triggers keep it
+# in sync: before a change they remove the affected problem's current row from the index
+# (FTS5 needs the indexed values to do that), after it they index the problem again.
+TABLE = "problem_search"
+SOURCE = "problem_search_source"
+COLUMNS = ("title", "description", "solution", "submissions")
+# bm25 weight of each column (and of languages, which only filters)
+WEIGHTS = (10.0, 2.0, 1.0, 1.0, 0.0)
+
+_TAG = re.compile(r"<[^>]+>")
+_ESCAPE = re.compile(r"\\u([0-9a-fA-F]{4})")
+# unicode61 would take a whole run of Chinese text for one word, so every CJK character is
+# indexed as a word of its own and a Chinese word in a query becomes a phrase of characters
+_CJK = "\u3400-\u9fff\uf900-\ufaff"
+_CJK_CHAR = re.compile(f"([{_CJK}])")
+# those spaces, also the ones next to a [hit], are taken out of snippets again
+_CJK_GAP = re.compile(f"(?<=[{_CJK}]) +(?=\\[?[{_CJK}])|(?<=[{_CJK}]\\]) +(?=\\[?[{_CJK}])")
+
+
+def _split_cjk(text):
+    return _CJK_CHAR.sub(r" \1 ", text)
+
+
+def search_text(value):
+    """Indexed form of a stored text column: decompressed, without HTML tags or entities,
+    without the \\uXXXX escapes submissions are stored with and with CJK characters apart"""
+    text = decompress(value)
+    if text is None:
+        return None
+    text = html.unescape(_TAG.sub(" ", text))
+    return _split_cjk(_ESCAPE.sub(lambda match: chr(int(match.group(1), 16)), text))
+
+
+def register(database):
+    """Make search_text() callable from SQL on every connection of `database`; the index
+    needs it, so writes from a client without it (e.g. the sqlite3 shell) fail instead of
+    leaving the index out of sync"""
+    database.register_function(search_text, "search_text", 1, deterministic=True)
+
+
+_SOURCE = f"""
+    CREATE VIEW IF NOT EXISTS {SOURCE} AS
+    SELECT p.id AS id, search_text(p.title) AS title, search_text(p.description) AS description,
+           (SELECT search_text(s.content) FROM solution s WHERE s.problem_id = p.id) AS solution,
+           (SELECT group_concat(search_text(s.source), char(10)) FROM submission s WHERE s.slug_id = p.slug)
+               AS submissions,
+           (SELECT group_concat(DISTINCT s.language) FROM submission s WHERE s.slug_id = p.slug) AS languages
+    FROM problem p"""
+
+_ALL = ", ".join(COLUMNS + ("languages",))
+
+
+def _remove(where):
+    """SQL that takes the problems `p` matching `where` out of the index, as they are now"""
+    return (f"INSERT INTO {TABLE} ({TABLE}, rowid, {_ALL}) SELECT 'delete', id, {_ALL} FROM {SOURCE} "
+            f"WHERE id IN (SELECT p.id FROM problem p WHERE {where});")
+
+
+def _add(where):
+    """SQL that indexes the problems `p` matching `where`, as they are now"""
+    return (f"INSERT INTO {TABLE} (rowid, {_ALL}) SELECT id, {_ALL} FROM {SOURCE} "
+            f"WHERE id IN (SELECT p.id FROM problem p WHERE {where});")
+
+
+def _triggers():
+    """(name, event, SQL) of every trigger; the crawler writes with INSERT OR REPLACE, whose
+    BEFORE INSERT trigger still sees the row that is about to be replaced"""
+    # problems a change of each table affects, before and after it
+    affected = {
+        "problem": {
+            "insert": ("p.id = NEW.id OR p.slug = NEW.slug OR p.display_id = NEW.display_id", "p.id = NEW.id"),
+            "update": ("p.id = OLD.id", "p.id = NEW.id"),
+            "delete": ("p.id = OLD.id", None),
+        },
+        "solution": {
+            "insert": ("p.id = NEW.problem_id",) * 2,
+            "update": ("p.id IN (OLD.problem_id, NEW.problem_id)",) * 2,
+            "delete": ("p.id = OLD.problem_id",) * 2,
+        },
+        "submission": {
+            "insert": ("p.slug = NEW.slug_id",) * 2,
+            "update": ("p.slug IN (OLD.slug_id, NEW.slug_id)",) * 2,
+            "delete": ("p.slug = OLD.slug_id",) * 2,
+        },
+    }
+    for table, events in affected.items():
+        for event, (before, after) in events.items():
+            yield f"{TABLE}_{table}_before_{event}", f"BEFORE {event.upper()} ON {table}", _remove(before)
+            if after:
+                yield f"{TABLE}_{table}_after_{event}", f"AFTER {event.upper()} ON {table}", _add(after)
+
+
+def create_index(database, tokenize="porter unicode61"):
+    """Create the index, its view and triggers, and fill it from the stored problems"""
+    database.execute_sql(_SOURCE)
+    database.execute_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5({_ALL}, "
+        f"content = '{SOURCE}', content_rowid = 'id', tokenize = '{tokenize}')"
+    )
+    for name, event, body in _triggers():
+        database.execute_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+    database.execute_sql(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('rebuild')")
+
+
+def match_expression(text, column=None, language=None, raw=False):
+    """FTS5 query for `text`: every word must occur (or, with raw=True, `text` is FTS5 query
+    syntax), optionally only in one of COLUMNS and only for problems with a submission in
+    a language starting with `language`"""
+    if raw:
+        expression = _split_cjk(text)
+    else:
+        expression = " ".join('"' + _split_cjk(word.replace('"', '""')) + '"' for word in text.split())
+    if column:
+        expression = f"{column} : ({expression})"
+    if language:
+        language = language.replace('"', '""')
+        expression = f'({expression}) AND languages : "{language}"*'
+    return expression
+
+
+def search(database, text, column=None, language=None, limit=20, raw=False):
+    """Best matching problems first, as dicts with id, display_id, title, slug and a snippet
+    of the best matching column with the hits in [brackets]"""
+    cursor = database.execute_sql(
+        f"SELECT p.id, p.display_id, p.title, p.slug, snippet({TABLE}, -1, '[', ']', '...', 12) "
+        f"FROM {TABLE} JOIN problem p ON p.id = {TABLE}.rowid "
+        f"WHERE {TABLE} MATCH ? ORDER BY bm25({TABLE}, {', '.join(map(str, WEIGHTS))}) LIMIT ?",
+        (match_expression(text, column, language, raw), limit)
+    )
+    return [
+        {"id": id, "display_id": display_id, "title": title, "slug": slug,
+         "snippet": _CJK_GAP.sub("", snippet).strip()}
+        for id, display_id, title, slug, snippet in cursor.fetchall()
+    ]
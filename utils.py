@@ -1,12 +1,66 @@
+import asyncio
 import random
+import threading
+from collections import deque
 from configparser import RawConfigParser
-from time import sleep
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep, time
+
+from metrics import metrics
 
 # load user info from config
 parser = RawConfigParser()
 parser.read('./project.conf')
 
 
+def sqlite_options(section):
+    """Keyword arguments for peewee's SqliteDatabase from the journal_mode, synchronous,
+    busy_timeout (ms), cache_size and mmap_size keys of a project.conf [DB*] section.
+
+    WAL lets readers (a render or status run) work while the crawler writes, and NORMAL
+    sync is safe with WAL; peewee opens one connection per thread and runs the pragmas on
+    each of them, busy_timeout included, so a busy writer makes others wait, not fail."""
+    busy_timeout = parser.getint(section, "busy_timeout", fallback=5000)
+    return {
+        "pragmas": {
+            "journal_mode": parser.get(section, "journal_mode", fallback="wal"),
+            "synchronous": parser.get(section, "synchronous", fallback="normal"),
+            "busy_timeout": busy_timeout,
+            "cache_size": parser.getint(section, "cache_size", fallback=-64000),
+            "mmap_size": parser.getint(section, "mmap_size", fallback=268435456),
+        },
+        # the sqlite3 module's own wait, in seconds
+        "timeout": busy_timeout / 1000,
+        "thread_safe": True,
+    }
+
+
+def schema_version(database):
+    """Last migration applied to the database, see migrate()"""
+    return database.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(database, migrations):
+    """Upgrade a database in place to the last of `migrations`, a list of (version, function)
+    pairs in version order; each function gets the database and must be safe to run on a
+    freshly created schema. The schema version is kept in PRAGMA user_version, and every
+    migration commits together with its version bump, so an interrupted upgrade resumes."""
+    current = start = schema_version(database)
+    for version, step in migrations:
+        if version <= current:
+            continue
+        print(f"[*] Migrating {database.database} to schema version {version}: {step.__doc__}")
+        with database.atomic():
+            step(database)
+            database.execute_sql(f"PRAGMA user_version = {int(version)}")
+        current = version
+    if current != start:
+        # rows a migration rewrote smaller (e.g. compressed) leave half-empty and free pages behind
+        print(f"[*] Vacuuming {database.database}")
+        database.execute_sql("VACUUM")
+    return current
+
+
 def random_wait(min_t=3, max_t=5):
     assert min_t < max_t
     seconds = random.random() * (max_t - min_t) + min_t
@@ -26,15 +80,293 @@ def get(dictionary, key):
     return dictionary
 
 
-def do(func, args=None, kwargs=None, max_retries=3):
+class FatalError(Exception):
+    """An error that retrying cannot fix, e.g. a slug that has no question"""
+
+
+class RetryableError(Exception):
+    """A transient error such as HTTP 429/5xx; retry_after is the server's Retry-After in seconds"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Pauses every caller when failures spike, e.g. expired cookies or a global 429.
+
+    Outcomes of the last `window` seconds are kept; once at least `min_calls` were seen
+    and the failure ratio reaches `threshold`, the breaker opens and every `wait()` blocks
+    for `cooldown` seconds before letting calls through again with a fresh window.
+    """
+
+    def __init__(self, threshold=0.5, window=60.0, min_calls=10, cooldown=60.0):
+        self.threshold = threshold
+        self.window = window
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque()
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        """Seconds until the breaker lets calls through again, 0 when it is closed"""
+        with self.lock:
+            return max(0.0, self.open_until - monotonic())
+
+    def wait(self):
+        delay = self.remaining()
+        if delay > 0:
+            sleep(delay)
+
+    def record(self, ok):
+        with self.lock:
+            now = monotonic()
+            self.outcomes.append((now, ok))
+            while self.outcomes and self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+            failures = sum(1 for _, success in self.outcomes if not success)
+            if now >= self.open_until and len(self.outcomes) >= self.min_calls \
+                    and failures / len(self.outcomes) >= self.threshold:
+                print(f"[!] {failures}/{len(self.outcomes)} recent calls failed, pausing all workers for {self.cooldown:.0f}s")
+                self.open_until = now + self.cooldown
+                self.outcomes.clear()
+
+
+class RetryPolicy:
+    """Retries retryable errors with exponential backoff and full jitter.
+
+    The n-th retry waits a random time in [0, min(max_delay, base_delay * 2 ** n)],
+    or the server's Retry-After if that is longer. FatalError, and errors from bad data
+    (KeyError, TypeError, AttributeError), are raised at once. Every attempt is reported
+    to the optional circuit breaker, which can pause all callers sharing the policy.
+    """
+
+    fatal = (FatalError, KeyError, TypeError, AttributeError)
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+
+    def is_retryable(self, error):
+        return not isinstance(error, self.fatal)
+
+    def delay(self, attempt, error=None):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = getattr(error, "retry_after", None)
+        return max(backoff, retry_after or 0)
+
+    def call(self, func, *args, max_attempts=None, **kwargs):
+        max_attempts = max_attempts or self.max_attempts
+        for attempt in range(max_attempts):
+            if self.breaker is not None:
+                self.breaker.wait()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                seconds = self._failed(func, e, attempt, max_attempts)
+                if seconds is None:
+                    raise
+                sleep(seconds)
+            else:
+                if self.breaker is not None:
+                    self.breaker.record(True)
+                return result
+
+    async def call_async(self, run, func, *args, max_attempts=None, **kwargs):
+        """call() for the async engine: awaits run(func, *args, **kwargs) and waits with asyncio.sleep"""
+        max_attempts = max_attempts or self.max_attempts
+        for attempt in range(max_attempts):
+            if self.breaker is not None and self.breaker.remaining() > 0:
+                await asyncio.sleep(self.breaker.remaining())
+            try:
+                result = await run(func, *args, **kwargs)
+            except Exception as e:
+                seconds = self._failed(func, e, attempt, max_attempts)
+                if seconds is None:
+                    raise
+                await asyncio.sleep(seconds)
+            else:
+                if self.breaker is not None:
+                    self.breaker.record(True)
+                return result
+
+    def _failed(self, func, error, attempt, max_attempts):
+        """Record a failed attempt; seconds to wait before the next one, None to give up"""
+        if self.breaker is not None:
+            self.breaker.record(False)
+        if not self.is_retryable(error) or attempt + 1 >= max_attempts:
+            print(f"Failed to execute {func}, giving up, Reason: {error}")
+            return None
+        seconds = self.delay(attempt, error)
+        metrics.count("retries", getattr(func, "__name__", str(func)))
+        print(f"Failed to execute {func}, retrying in {seconds:.1f}s, Reason: {error}")
+        return seconds
+
+
+default_policy = RetryPolicy()
+
+
+def do(func, args=None, kwargs=None, max_retries=None, policy=None):
+    """Call func under a retry policy; the last error is raised once retries are exhausted"""
     if args is None:
         args = []
     if kwargs is None:
         kwargs = {}
+    return (policy or default_policy).call(func, *args, max_attempts=max_retries, **kwargs)
+
+
+def make_retry_policy(section):
+    """Build a RetryPolicy with a CircuitBreaker from the retry_* and breaker_* keys of a project.conf section"""
+    return RetryPolicy(
+        max_attempts=parser.getint(section, "retry_attempts", fallback=3),
+        base_delay=parser.getfloat(section, "retry_base_delay", fallback=1.0),
+        max_delay=parser.getfloat(section, "retry_max_delay", fallback=60.0),
+        breaker=CircuitBreaker(
+            threshold=parser.getfloat(section, "breaker_threshold", fallback=0.5),
+            window=parser.getfloat(section, "breaker_window", fallback=60.0),
+            min_calls=parser.getint(section, "breaker_min_calls", fallback=10),
+            cooldown=parser.getfloat(section, "breaker_cooldown", fallback=60.0)
+        )
+    )
+
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header (delta seconds or HTTP date), None if absent or malformed"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket shared by all workers of a crawler.
+
+    Every request takes one token; tokens refill at `rate` per second up to `burst`.
+    The rate adapts AIMD style: it is multiplied by `backoff` on HTTP 429/5xx (at most
+    once per `cooldown` seconds, so one burst of errors counts once), honours Retry-After
+    by pausing the whole bucket, and grows by `increase` * `max_rate` per healthy response
+    up to `max_rate`, so recovering from the floor takes about 1 / `increase` responses.
+    """
+
+    def __init__(self, rate=2.0, min_rate=0.2, max_rate=None, burst=1, backoff=0.5, increase=0.02, cooldown=1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.burst = burst
+        self.backoff = backoff
+        self.increase = increase
+        self.cooldown = cooldown
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.last_backoff = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()  # see call_reserved
 
-    while max_retries > 0:
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token and return how many seconds the caller must wait before using it"""
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            delay = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(delay, self.paused_until - now)
+
+    def try_acquire(self):
+        """Take a token if one is free and the bucket is not paused, and return 0; otherwise
+        take nothing and return how many seconds to wait before trying again"""
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        if getattr(self.local, "reserved", False):
+            # the caller reserved and waited for this token already, see call_reserved
+            self.local.reserved = False
+            return
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
+
+    def refund(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def call_reserved(self, func, *args, **kwargs):
+        """Call func, whose first request uses a token the caller already took (the async
+        engine waits for it on its event loop); the token is given back if func made no request"""
+        self.local.reserved = True
         try:
             return func(*args, **kwargs)
-        except Exception as e:
-            print(f"Failed to execute {func}, Reason: {e}")
-            max_retries -= 1
+        finally:
+            if self.local.reserved:
+                self.local.reserved = False
+                self.refund()
+
+    def feedback(self, status_code=None, retry_after=None):
+        """Adapt the rate to a response; status_code None means the request failed outright"""
+        throttled = status_code is None or status_code == 429 or status_code >= 500
+        pause = retry_after_seconds(retry_after)
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            if pause is not None:
+                self.paused_until = max(self.paused_until, now + pause)
+            if throttled or pause is not None:
+                if now - self.last_backoff >= self.cooldown:
+                    self.rate = max(self.min_rate, self.rate * self.backoff)
+                    self.last_backoff = now
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase * self.max_rate)
+
+
+def make_rate_limiter(section):
+    """Build a RateLimiter from the rate, min_rate, max_rate and burst keys of a project.conf section"""
+    rate = parser.getfloat(section, "rate", fallback=2.0)
+    return RateLimiter(
+        rate=rate,
+        min_rate=parser.getfloat(section, "min_rate", fallback=0.2),
+        max_rate=parser.getfloat(section, "max_rate", fallback=rate),
+        burst=parser.getint(section, "burst", fallback=1)
+    )
+
+
+def throttle(session, limiter):
+    """Route every request made through a requests.Session via the limiter.
+    HTTP 429/5xx responses are raised as RetryableError so the retry policy can back off."""
+    request = session.request
+
+    def throttled(method, url, *args, **kwargs):
+        limiter.acquire()
+        try:
+            resp = request(method, url, *args, **kwargs)
+        except Exception:
+            limiter.feedback(None)
+            raise
+        retry_after = resp.headers.get("Retry-After")
+        limiter.feedback(resp.status_code, retry_after)
+        if resp.status_code == 429 or resp.status_code >= 500:
+            raise RetryableError(f"HTTP {resp.status_code} from {url}", retry_after_seconds(retry_after))
+        return resp
+
+    session.request = throttled
+    return session
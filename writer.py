@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+
+from peewee import chunked
+
+_STOP = object()
+
+
+class DatabaseWriter:
+    """Single writer for the crawler.
+
+    Worker threads put rows on a queue instead of writing themselves; one dedicated
+    thread drains it and stores them with insert_many / on_conflict_replace, one
+    transaction per flush. A flush happens every `batch_size` rows or `flush_interval`
+    seconds, whichever comes first, and on close.
+
+    Every row is queued with its owner, the slug of the problem it belongs to (None for rows
+    shared between problems, like tags). When a flush fails it is retried one owner at a
+    time, so a bad row only loses its own problem: that owner goes into `failed` and its
+    later rows are dropped. `on_written(model, row)` is called for every row that landed.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1.0, on_written=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_written = on_written
+        self.queue = queue.Queue()
+        self.thread = None
+        self.written = 0
+        self.failed = set()  # owners with rows that could not be written
+        self.write_time = 0.0  # seconds spent inside write transactions
+        self.database = None  # the database of the rows written so far
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, model, row, owner=None):
+        """Queue an insert-or-replace of one row of problem `owner`"""
+        self.queue.put((model, row, owner))
+
+    def close(self):
+        """Flush everything queued so far and stop the writer thread"""
+        if self.thread is not None:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is not None and item is not _STOP:
+                pending.append(item)
+            if item is _STOP or len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(pending)
+                pending = []
+                deadline = time.monotonic() + self.flush_interval
+            if item is _STOP:
+                # peewee keeps one connection per thread, this one ends with the thread
+                if self.database is not None and not self.database.is_closed():
+                    self.database.close()
+                return
+
+    def _flush(self, pending):
+        # the rest of a failed problem would land without it, e.g. its SyncState
+        pending = [item for item in pending if item[2] is None or item[2] not in self.failed]
+        if not pending:
+            return
+        database = self.database = pending[0][0]._meta.database
+        started = time.perf_counter()
+        try:
+            with database.atomic():
+                self._insert(pending)
+            landed = pending
+        except Exception as e:
+            print(f"[!] Failed to write {len(pending)} rows ({e}), retrying problem by problem")
+            landed = self._flush_by_owner(database, pending)
+        self.write_time += time.perf_counter() - started
+        self.written += len(landed)
+        if self.on_written is not None:
+            for model, row, _ in landed:
+                self.on_written(model, row)
+
+    def _flush_by_owner(self, database, pending):
+        """Write the rows of each owner in a transaction of their own; returns the rows that landed"""
+        groups = {}
+        for item in pending:
+            # rows without an owner are written one by one
+            groups.setdefault(item[2] if item[2] is not None else id(item), []).append(item)
+        landed = []
+        for items in groups.values():
+            try:
+                with database.atomic():
+                    self._insert(items)
+                landed.extend(items)
+            except Exception as e:
+                model, _, owner = items[0]
+                if owner is not None:
+                    self.failed.add(owner)
+                print(f"[!] Failed to write {len(items)} rows of {owner or model.__name__}: {e}")
+        return landed
+
+    @staticmethod
+    def _insert(items):
+        # group rows by table and column set, keeping the order tables were first seen
+        groups = {}
+        for model, row, _ in items:
+            groups.setdefault((model, tuple(sorted(row))), []).append(row)
+        for (model, _), rows in groups.items():
+            for batch in chunked(rows, 100):
+                model.insert_many(batch).on_conflict_replace().execute()